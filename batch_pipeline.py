@@ -0,0 +1,310 @@
+"""
+Офлайн-генерация через OpenAI Batch API
+
+Для больших списков тем, где задержка не важна: из тем собирается JSONL-файл
+запросов (с текущим системным промптом), он загружается и ставится в пакетную
+обработку, затем скрипт ждет завершения, скачивает результат и рисует
+карточки ImageGenerator. Состояние задания хранится в batch_state.json,
+поэтому после падения запуск продолжается с прерванного шага.
+
+Шаги (run выполняет их по очереди):
+    prepare — собрать requests.jsonl
+    submit  — загрузить файл и создать пакетное задание
+    wait    — дождаться завершения
+    ingest  — скачать результат, нарисовать карточки, записать ZIP и manifest.jsonl
+
+Пример:
+    python batch_pipeline.py run topics.txt --out batch_output
+    python batch_pipeline.py run topics.txt --out batch_output --base-url http://127.0.0.1:8000/v1
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from typing import Dict, List
+
+from threads_cards.errors import ThreadGenerationError
+from threads_cards.llm import ThreadsCardGenerator
+from threads_cards.prompts import DEFAULT_SYSTEM_PROMPT
+from threads_cards.render import CARD_SIZES, RENDER_MODES, CardEncoder, ImageGenerator
+from threads_cards.storage import sanitize_filename, write_zip
+from threads_cards.topics import load_topics
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+MAX_BATCH_REQUESTS = 50_000
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchJob:
+    """Локальное состояние пакетного задания (batch_state.json в каталоге вывода)"""
+
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        self.state_path = os.path.join(out_dir, "batch_state.json")
+        self.requests_path = os.path.join(out_dir, "requests.jsonl")
+        self.manifest_path = os.path.join(out_dir, "manifest.jsonl")
+        self.zip_dir = os.path.join(out_dir, "zips")
+        self.state: Dict = {"step": "new"}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as state_file:
+                self.state = json.load(state_file)
+
+    def save(self, **changes) -> None:
+        """Обновляет состояние и атомарно записывает его на диск"""
+        self.state.update(changes)
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as state_file:
+            json.dump(self.state, state_file, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    @property
+    def step(self) -> str:
+        return self.state["step"]
+
+
+def prepare(job: BatchJob, generator: ThreadsCardGenerator, topics: List[str]) -> None:
+    """Собирает файл запросов: по строке на тему, custom_id связывает ответ с темой"""
+    if len(topics) > MAX_BATCH_REQUESTS:
+        raise ValueError(f"В одном пакете не больше {MAX_BATCH_REQUESTS} запросов, тем: {len(topics)}")
+    custom_ids = {}
+    with open(job.requests_path, "w", encoding="utf-8") as requests_file:
+        for idx, topic in enumerate(topics, start=1):
+            custom_id = f"topic-{idx:06d}"
+            custom_ids[custom_id] = topic
+            line = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": generator.build_request(topic),
+            }
+            requests_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+    job.save(
+        step="prepared",
+        custom_ids=custom_ids,
+        system_prompt=generator.system_prompt,
+        job_id=uuid.uuid4().hex,
+        prepared_at=int(time.time()),
+    )
+    print(f"Подготовлено запросов: {len(topics)} → {job.requests_path}", file=sys.stderr)
+
+
+def _find_submitted_batch(job: BatchJob, generator: ThreadsCardGenerator):
+    """Задание, созданное этим job_id в прошлом запуске (падение до сохранения batch_id), или None"""
+    # Список идет от новых к старым: задания старше prepare смотреть незачем
+    for batch in generator.client.batches.list(limit=100):
+        if batch.created_at < job.state.get("prepared_at", 0):
+            break
+        if (batch.metadata or {}).get("job_id") == job.state["job_id"]:
+            return batch
+    return None
+
+
+def submit(job: BatchJob, generator: ThreadsCardGenerator) -> None:
+    """
+    Загружает файл запросов и создает пакетное задание
+
+    ID файла сохраняется до создания задания, а job_id передается в metadata:
+    повторный запуск после падения находит уже созданное (и оплаченное)
+    задание вместо создания второго.
+    """
+    batch = None
+    if not job.state.get("job_id"):
+        # Состояние от версии без job_id
+        job.save(job_id=uuid.uuid4().hex)
+    if job.state.get("input_file_id"):
+        batch = _find_submitted_batch(job, generator)
+    else:
+        with open(job.requests_path, "rb") as requests_file:
+            uploaded = generator.client.files.create(file=requests_file, purpose="batch")
+        job.save(input_file_id=uploaded.id)
+    if batch is None:
+        batch = generator.client.batches.create(
+            input_file_id=job.state["input_file_id"],
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata={"source": "threads_cards", "job_id": job.state["job_id"]},
+        )
+        print(f"Задание создано: {batch.id}", file=sys.stderr)
+    else:
+        print(f"Найдено созданное ранее задание: {batch.id}", file=sys.stderr)
+    job.save(step="submitted", batch_id=batch.id, batch_status=batch.status)
+
+
+def wait(job: BatchJob, generator: ThreadsCardGenerator, poll_seconds: float) -> None:
+    """Опрашивает задание до финального статуса"""
+    while True:
+        batch = generator.client.batches.retrieve(job.state["batch_id"])
+        counts = batch.request_counts
+        progress = f"{counts.completed}/{counts.total}" if counts else "?"
+        print(f"Статус {batch.id}: {batch.status} ({progress})", file=sys.stderr)
+        job.save(batch_status=batch.status)
+        if batch.status in FINAL_STATUSES:
+            break
+        time.sleep(poll_seconds)
+
+    if batch.status != "completed" and not batch.output_file_id:
+        job.save(step="failed")
+        raise RuntimeError(f"Пакетное задание завершилось со статусом {batch.status}")
+    job.save(step="completed", output_file_id=batch.output_file_id, error_file_id=batch.error_file_id)
+
+
+def _ingested_statuses(job: BatchJob) -> Dict[str, str]:
+    """Статусы тем, уже записанных в manifest.jsonl (custom_id → ok/error)"""
+    statuses = {}
+    if os.path.exists(job.manifest_path):
+        with open(job.manifest_path, encoding="utf-8") as manifest_file:
+            for line in manifest_file:
+                try:
+                    record = json.loads(line)
+                    statuses[record["custom_id"]] = record.get("status", "error")
+                except (ValueError, KeyError):
+                    continue
+    return statuses
+
+
+def _download_lines(generator: ThreadsCardGenerator, file_id: str | None) -> List[Dict]:
+    if not file_id:
+        return []
+    content = generator.client.files.content(file_id).text
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def ingest(job: BatchJob, generator: ThreadsCardGenerator, image_generator: ImageGenerator, render_mode: str) -> int:
+    """
+    Рисует карточки по результатам задания; возвращает число тем с ошибкой
+
+    Ошибкой считаются и темы из прошлых запусков (по manifest.jsonl), и темы,
+    для которых в результатах задания нет строки.
+    """
+    os.makedirs(job.zip_dir, exist_ok=True)
+    custom_ids = job.state["custom_ids"]
+    statuses = _ingested_statuses(job)
+    results = _download_lines(generator, job.state.get("output_file_id"))
+    results += _download_lines(generator, job.state.get("error_file_id"))
+
+    failures = 0
+    with open(job.manifest_path, "a", encoding="utf-8") as manifest_file:
+        for result in results:
+            custom_id = result.get("custom_id")
+            if custom_id in statuses or custom_id not in custom_ids:
+                continue
+            record = {"custom_id": custom_id, "topic": custom_ids[custom_id]}
+            try:
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    error = result.get("error") or response.get("body", {}).get("error")
+                    raise ThreadGenerationError(f"Ошибка при генерации контента: {error}")
+                raw_content = response["body"]["choices"][0]["message"]["content"]
+                thread_content = generator.repair_content(generator.finish_content(raw_content))
+                if not thread_content.get("replies"):
+                    raise ValueError("Модель вернула пустой список реплик")
+
+                images = image_generator.render_thread(thread_content, render_mode)
+                theme = thread_content.get("theme", record["topic"])
+                zip_name = f"{sanitize_filename(theme)}_{sanitize_filename(str(thread_content['id']))}.zip"
+                write_zip(os.path.join(job.zip_dir, zip_name), images, theme)
+                record.update(
+                    status="ok",
+                    id=thread_content["id"],
+                    theme=theme,
+                    zip=os.path.join(os.path.basename(job.zip_dir), zip_name),
+                    cards=len(images),
+                    replies=thread_content.get("replies", []),
+                    cta=thread_content.get("cta"),
+                    tags=thread_content.get("tags", []),
+                )
+            except (ThreadGenerationError, ValueError, KeyError, IndexError, OSError) as error:
+                record.update(status="error", error=str(error), error_type=type(error).__name__)
+            manifest_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            manifest_file.flush()
+            statuses[custom_id] = record["status"]
+
+    missing = [custom_id for custom_id in custom_ids if custom_id not in statuses]
+    for custom_id in missing:
+        print(f"Нет результата для темы {custom_ids[custom_id]!r} ({custom_id})", file=sys.stderr)
+    failures = sum(1 for status in statuses.values() if status != "ok") + len(missing)
+    job.save(step="ingested")
+    print(
+        f"Обработано результатов: {len(statuses)} из {len(custom_ids)}, ошибок: {failures}"
+        f" (из них без результата: {len(missing)})",
+        file=sys.stderr,
+    )
+    return failures
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Генерация карточек Threads через OpenAI Batch API")
+    parser.add_argument("command", choices=["run", "prepare", "submit", "wait", "ingest", "status"])
+    parser.add_argument("topics", nargs="?", help="файл с темами (нужен для run/prepare нового задания)")
+    parser.add_argument("--out", default="batch_output", help="каталог задания")
+    parser.add_argument("--api-key", default=os.getenv("OPENAI_API_KEY", ""), help="ключ OpenAI (по умолчанию OPENAI_API_KEY)")
+    parser.add_argument("--base-url", help="адрес совместимого с OpenAI сервера (например, локальной заглушки)")
+    parser.add_argument("--system-prompt", help="файл с системным промптом вместо стандартного")
+    parser.add_argument("--poll-seconds", type=float, default=60)
+    parser.add_argument("--image-format", choices=list(CardEncoder.FORMATS), default="png")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=[name for name in CARD_SIZES if name != "square"],
+        default=[],
+        help="дополнительные размеры карточек (папки в ZIP) помимо квадрата 1080×1080",
+    )
+    parser.add_argument("--render-mode", choices=RENDER_MODES, default="auto")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    job = BatchJob(args.out)
+    if args.command == "status":
+        summary = {k: v for k, v in job.state.items() if k not in ("custom_ids", "system_prompt")}
+        summary["requests"] = len(job.state.get("custom_ids", {}))
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+        return 0
+    if not args.api_key:
+        parser.error("укажите --api-key или переменную окружения OPENAI_API_KEY")
+
+    system_prompt = job.state.get("system_prompt") or DEFAULT_SYSTEM_PROMPT
+    if args.system_prompt:
+        with open(args.system_prompt, encoding="utf-8") as prompt_file:
+            system_prompt = prompt_file.read()
+    generator = ThreadsCardGenerator(api_key=args.api_key, system_prompt=system_prompt, base_url=args.base_url)
+    image_generator = ImageGenerator(
+        fit_text=True,
+        image_format=args.image_format,
+        compress_level=args.compress_level,
+        extra_sizes=tuple(args.sizes),
+    )
+
+    steps = ["prepare", "submit", "wait", "ingest"] if args.command == "run" else [args.command]
+    # Шаги, уже выполненные до падения, при run пропускаются. Неудачное задание
+    # снова проходит wait: он перечитывает финальный статус и опять сообщает об ошибке
+    done_after = {"prepared": 1, "submitted": 2, "completed": 3, "ingested": 4, "failed": 2}
+    if args.command == "run":
+        steps = steps[done_after.get(job.step, 0):]
+        if job.step == "ingested":
+            steps = ["ingest"]
+
+    failures = 0
+    for step in steps:
+        if step == "prepare":
+            if not args.topics:
+                parser.error("для нового задания нужен файл тем")
+            prepare(job, generator, load_topics(args.topics))
+        elif step == "submit":
+            submit(job, generator)
+        elif step == "wait":
+            try:
+                wait(job, generator, args.poll_seconds)
+            except RuntimeError as error:
+                print(error, file=sys.stderr)
+                return 1
+        elif step == "ingest":
+            failures = ingest(job, generator, image_generator, args.render_mode)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
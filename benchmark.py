@@ -0,0 +1,357 @@
+"""
+Воспроизводимые замеры горячих путей рендеринга и упаковки
+
+Прогоняет корпус тредов из benchmarks/corpus.jsonl (длинные реплики, эмодзи,
+плотная разметка) через этапы: _format_sentences, _parse_markdown, перенос
+строк, create_card целиком, кодирование PNG и images_to_zip. Сеть не нужна.
+Для каждого этапа печатаются пропускная способность, p50/p95 и пик памяти
+Python (tracemalloc), затем результат сравнивается с benchmarks/baseline.json:
+если этап медленнее или прожорливее базовой линии больше допуска, код
+возврата — 1. Порог по времени проверяется по лучшему раунду (среднее время
+на элемент): одиночные замеры микросекундных вызовов слишком шумные, а p50/p95
+остаются в отчете для анализа.
+
+Кэш раскладок отключается, чтобы повторные раунды не мерили попадания в
+него. Перед замерами выполняется короткая калибровка процессора: пороги
+времени масштабируются на отношение калибровок, так что общее ускорение или
+замедление машины между запусками не считается регрессией. При смене
+окружения базовую линию все равно стоит записать заново (--save-baseline).
+
+Пример:
+    python benchmark.py
+    python benchmark.py --rounds 10 --tolerance 0.3 --json bench_report.json
+    python benchmark.py --save-baseline
+    python benchmark.py --cold-start
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+from typing import Callable, Dict, List, NamedTuple
+
+from threads_cards.metrics import StageMetrics
+from threads_cards.render import (
+    CardEncoder,
+    CardTemplateCache,
+    ImageGenerator,
+    TextMetricsCache,
+    render_card_payload,
+)
+from threads_cards.storage import images_to_zip
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+DEFAULT_CORPUS = os.path.join(BENCH_DIR, "corpus.jsonl")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+
+class BenchResult(NamedTuple):
+    """Итог одного этапа"""
+    name: str
+    unit: str
+    items: int
+    best_ms: float
+    p50_ms: float
+    p95_ms: float
+    throughput: float
+    peak_kb: float
+
+
+class BenchContext:
+    """Корпус и заранее подготовленные входные данные для каждого этапа"""
+
+    def __init__(self, corpus: List[Dict], image_format: str, compress_level: int):
+        self.corpus = corpus
+        self.generator = ImageGenerator(
+            fit_text=True,
+            metrics=TextMetricsCache(),
+            templates=CardTemplateCache(),
+            image_format=image_format,
+            compress_level=compress_level,
+        )
+        # Каждый раунд должен верстать заново, а не брать раскладку из кэша
+        self.generator.layout_engine.max_cached_layouts = 0
+        self.replies = [
+            (reply["role"], reply["text"], idx, len(thread["replies"]))
+            for thread in corpus
+            for idx, reply in enumerate(thread["replies"], start=1)
+        ]
+        self.formatted = [self.generator._format_sentences(text) for _, text, _, _ in self.replies]
+        self.tokens = [self.generator._tokenize(text) for _, text, _, _ in self.replies]
+        self.cards = [self.generator.create_card(*reply) for reply in self.replies]
+        self.payloads = []
+        position = 0
+        for thread in corpus:
+            count = len(thread["replies"])
+            self.payloads.append([render_card_payload(self.generator, *reply) for reply in self.replies[position:position + count]])
+            position += count
+
+
+def _timed(calls: List[Callable[[], object]]) -> List[float]:
+    samples = []
+    for call in calls:
+        started = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def _format_sentences_calls(ctx: BenchContext) -> List[Callable[[], object]]:
+    return [lambda text=text: ctx.generator._format_sentences(text) for _, text, _, _ in ctx.replies]
+
+
+def _parse_markdown_calls(ctx: BenchContext) -> List[Callable[[], object]]:
+    return [lambda text=text: ctx.generator._parse_markdown(text) for text in ctx.formatted]
+
+
+def _wrap_calls(ctx: BenchContext) -> List[Callable[[], object]]:
+    generator = ctx.generator
+    max_width = generator.width - generator.padding * 2
+    return [
+        lambda tokens=tokens: generator.layout_engine.layout(tokens, generator.font_size, max_width, generator.line_spacing)
+        for tokens in ctx.tokens
+    ]
+
+
+def _create_card_calls(ctx: BenchContext) -> List[Callable[[], object]]:
+    return [lambda reply=reply: ctx.generator.create_card(*reply) for reply in ctx.replies]
+
+
+def _encode_calls(ctx: BenchContext) -> List[Callable[[], object]]:
+    return [lambda card=card: ctx.generator.encoder.encode(card) for card in ctx.cards]
+
+
+def _zip_calls(ctx: BenchContext) -> List[Callable[[], object]]:
+    return [
+        lambda thread=thread, payloads=payloads: images_to_zip(payloads, thread["theme"])
+        for thread, payloads in zip(ctx.corpus, ctx.payloads)
+    ]
+
+
+# имя этапа -> (единица пропускной способности, построитель вызовов, повторов корпуса за раунд);
+# быстрые этапы повторяются чаще, чтобы перцентили считались по достаточной выборке
+BENCHMARKS: Dict[str, tuple] = {
+    "format_sentences": ("реплик/с", _format_sentences_calls, 10),
+    "parse_markdown": ("реплик/с", _parse_markdown_calls, 10),
+    "wrap": ("реплик/с", _wrap_calls, 10),
+    "create_card": ("карточек/с", _create_card_calls, 1),
+    "encode": ("карточек/с", _encode_calls, 1),
+    "zip": ("тредов/с", _zip_calls, 20),
+}
+
+
+def calibrate(repeats: int = 7) -> float:
+    """
+    Медианное время фиксированной нагрузки, с: цикл на Python плюс zlib и
+    копирование памяти — те же ресурсы, что тратят верстка, PNG и ZIP
+    """
+    payload = bytes(range(256)) * 4096
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        total = 0
+        for value in range(100_000):
+            total += value * value % 7
+        zlib.compress(payload, 6)
+        bytearray(payload) * 4
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+# Что импортирует холодный процесс: рабочий процесс пула рендеринга,
+# фоновая генерация, свежий процесс Streamlit и сам SDK OpenAI для сравнения
+COLD_START_TARGETS = {
+    "threads_cards.render": "import threads_cards.render",
+    "threads_cards.jobs": "import threads_cards.jobs",
+    "streamlit_app": "import streamlit_app",
+    "openai": "import openai",
+}
+
+
+def measure_cold_start(rounds: int) -> List[Dict]:
+    """
+    Время импорта в свежем интерпретаторе (медиана по раундам, мс) и то,
+    подтянул ли импорт пакет openai
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for name, statement in COLD_START_TARGETS.items():
+        code = (
+            "import sys, time; started = time.perf_counter(); "
+            f"{statement}; print((time.perf_counter() - started) * 1000, 'openai' in sys.modules)"
+        )
+        samples = []
+        for _ in range(rounds):
+            output = subprocess.run(
+                [sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True
+            ).stdout.split()
+            samples.append(float(output[0]))
+        rows.append({"module": name, "median_ms": round(statistics.median(samples), 1), "openai_loaded": output[1] == "True"})
+    return rows
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_benchmark(name: str, ctx: BenchContext, rounds: int) -> BenchResult:
+    """Прогрев, rounds замеренных раундов и отдельный раунд под tracemalloc"""
+    unit, build_calls, repeat = BENCHMARKS[name]
+    calls = build_calls(ctx) * repeat
+    _timed(calls)
+
+    samples = []
+    round_means = []
+    gc.collect()
+    for _ in range(rounds):
+        round_samples = _timed(calls)
+        samples.extend(round_samples)
+        round_means.append(sum(round_samples) / len(round_samples))
+
+    # tracemalloc замедляет вызовы, поэтому память меряется отдельно от времени
+    gc.collect()
+    tracemalloc.start()
+    _timed(calls)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ordered = sorted(samples)
+    return BenchResult(
+        name=name,
+        unit=unit,
+        items=len(samples),
+        best_ms=round(min(round_means) * 1000, 4),
+        p50_ms=round(statistics.median(ordered) * 1000, 4),
+        p95_ms=round(_percentile(ordered, 0.95) * 1000, 4),
+        throughput=round(len(samples) / sum(samples), 1),
+        peak_kb=round(peak / 1024, 1),
+    )
+
+
+def compare(
+    results: List[BenchResult],
+    baseline: Dict,
+    tolerance: float,
+    memory_tolerance: float,
+    speed_scale: float = 1.0,
+) -> List[str]:
+    """
+    Регрессии относительно базовой линии (пустой список — все в допуске)
+
+    speed_scale — во сколько раз эта машина сейчас медленнее, чем при записи
+    базовой линии; на него умножаются эталонные времена.
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get("benchmarks", {}).get(result.name)
+        if not base:
+            continue
+        for field, limit in (("best_ms", tolerance), ("peak_kb", memory_tolerance)):
+            current, reference = getattr(result, field), base.get(field)
+            if reference and field != "peak_kb":
+                reference = round(reference * speed_scale, 4)
+            if reference and current > reference * (1 + limit):
+                regressions.append(f"{result.name}.{field}: {current} против {reference} (допуск {limit:.0%})")
+    return regressions
+
+
+def _load_corpus(path: str) -> List[Dict]:
+    with open(path, encoding="utf-8") as corpus_file:
+        return [json.loads(line) for line in corpus_file if line.strip()]
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Замеры рендеринга и упаковки карточек")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--rounds", type=int, default=7, help="сколько раз прогонять корпус после прогрева")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="запустить только эти этапы")
+    parser.add_argument("--tolerance", type=float, default=0.30, help="допустимое замедление лучшего раунда (доля)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10, help="допустимый рост пика памяти (доля)")
+    parser.add_argument("--image-format", choices=list(CardEncoder.FORMATS), default="png")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=6, metavar="0-9")
+    parser.add_argument("--json", help="записать отчет в JSON-файл")
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат как новую базовую линию")
+    parser.add_argument(
+        "--cold-start",
+        action="store_true",
+        help="вместо этапов замерить время импорта модулей в свежем процессе",
+    )
+    args = parser.parse_args(argv)
+    if args.rounds < 1:
+        parser.error("--rounds должен быть положительным")
+
+    if args.cold_start:
+        rows = measure_cold_start(args.rounds)
+        print(f"{'модуль':<24}{'импорт, мс':>12}  openai")
+        for row in rows:
+            print(f"{row['module']:<24}{row['median_ms']:>12.1f}  {'да' if row['openai_loaded'] else 'нет'}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as report_file:
+                json.dump({"python": platform.python_version(), "cold_start": rows}, report_file, ensure_ascii=False, indent=2)
+        return 0
+
+    calibration = calibrate()
+    corpus = _load_corpus(args.corpus)
+    ctx = BenchContext(corpus, args.image_format, args.compress_level)
+    print(f"Корпус: {len(corpus)} тредов, {len(ctx.replies)} реплик; раундов: {args.rounds}", file=sys.stderr)
+
+    results = [run_benchmark(name, ctx, args.rounds) for name in args.only or BENCHMARKS]
+    print(f"{'этап':<18}{'лучший, мс':>11}{'p50, мс':>10}{'p95, мс':>10}{'скорость':>12}  {'':<11}{'пик, КБ':>10}")
+    for result in results:
+        print(
+            f"{result.name:<18}{result.best_ms:>11.4f}{result.p50_ms:>10.3f}{result.p95_ms:>10.3f}"
+            f"{result.throughput:>12.1f}  {result.unit:<11}{result.peak_kb:>10.1f}"
+        )
+    peak_rss = StageMetrics.peak_rss_bytes()
+    if peak_rss is not None:
+        print(f"Пиковая память процесса: {peak_rss / 1024 / 1024:.1f} МБ")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}, CPU: {os.cpu_count()}",
+        "image_format": args.image_format,
+        "compress_level": args.compress_level,
+        "rounds": args.rounds,
+        "calibration_seconds": round(calibration, 5),
+        "peak_rss_bytes": peak_rss,
+        "benchmarks": {result.name: result._asdict() for result in results},
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(report, baseline_file, ensure_ascii=False, indent=2)
+            baseline_file.write("\n")
+        print(f"Базовая линия записана: {args.baseline}", file=sys.stderr)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("Базовой линии нет — сравнение пропущено (запишите ее через --save-baseline)", file=sys.stderr)
+        return 0
+    with open(args.baseline, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+    if (baseline.get("image_format"), baseline.get("compress_level")) != (args.image_format, args.compress_level):
+        print("Базовая линия записана для другого формата — сравнение пропущено", file=sys.stderr)
+        return 0
+    speed_scale = calibration / baseline["calibration_seconds"] if baseline.get("calibration_seconds") else 1.0
+    print(f"Скорость машины относительно базовой линии: ×{1 / speed_scale:.2f}", file=sys.stderr)
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance, speed_scale)
+    for regression in regressions:
+        print(f"РЕГРЕССИЯ {regression}", file=sys.stderr)
+    if not regressions:
+        print("Все этапы в пределах допуска базовой линии", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""
+Массовая генерация карточек без веб-интерфейса
+
+Читает файл тем (по одной на строку), генерирует треды параллельно через
+асинхронный клиент OpenAI, рисует карточки ImageGenerator и складывает
+ZIP каждого треда в каталог вывода. Итог по каждой теме дописывается в
+manifest.jsonl; при повторном запуске уже готовые темы пропускаются.
+
+Пример:
+    python bulk_generate.py topics.txt --out output --concurrency 8 --rpm 120
+    python bulk_generate.py topics.txt --out output --posts-per-request 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+from threads_cards.errors import ThreadGenerationError
+from threads_cards.llm import LLMResponseCache, ThreadsCardGenerator
+from threads_cards.metrics import get_stage_metrics
+from threads_cards.prompts import DEFAULT_SYSTEM_PROMPT
+from threads_cards.render import CARD_SIZES, RENDER_MODES, CardEncoder, ImageGenerator
+from threads_cards.storage import sanitize_filename, write_zip
+from threads_cards.topics import load_topics
+
+
+class AsyncTokenBucket:
+    """
+    Ограничитель частоты запросов: не более rate запросов в секунду
+    с допустимым всплеском capacity
+
+    pause() опустошает ведро на заданное время — вызывается после ответа 429,
+    чтобы остальные задачи не добивали лимит.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Ждет, пока в ведре появится токен, и забирает его"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Запрещает новые запросы примерно на seconds секунд"""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class RateLimitedGenerator(ThreadsCardGenerator):
+    """ThreadsCardGenerator, каждая попытка которого проходит через общий ограничитель"""
+
+    def __init__(self, *args, bucket: AsyncTokenBucket, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket
+
+    async def _before_attempt(self) -> None:
+        await self.bucket.acquire()
+
+    def _on_retry(self, error: Exception, delay: float) -> None:
+        # После 429 останавливаем и остальные задачи, а не только эту
+        if getattr(error, "status_code", None) == 429:
+            self.bucket.pause(delay)
+
+
+def _load_completed(manifest_path: str) -> set:
+    """Темы, которые уже успешно обработаны в прошлых запусках"""
+    completed = set()
+    if not os.path.exists(manifest_path):
+        return completed
+    with open(manifest_path, encoding="utf-8") as manifest_file:
+        for line in manifest_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Последняя строка могла оборваться при прерывании
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["topic"])
+    return completed
+
+
+async def _save_thread(
+    topic: str,
+    thread_content: Dict,
+    image_generator: ImageGenerator,
+    render_mode: str,
+    zip_dir: str,
+) -> Dict:
+    """Рисует карточки готового треда и сохраняет ZIP; возвращает поля записи манифеста"""
+    # Рендеринг нагружает CPU — уводим его из цикла событий
+    images = await asyncio.to_thread(image_generator.render_thread, thread_content, render_mode)
+    theme = thread_content.get("theme", topic)
+    zip_name = f"{sanitize_filename(theme)}_{sanitize_filename(str(thread_content['id']))}.zip"
+    await asyncio.to_thread(write_zip, os.path.join(zip_dir, zip_name), images, theme)
+    return dict(
+        status="ok",
+        id=thread_content["id"],
+        theme=theme,
+        zip=os.path.join(os.path.basename(zip_dir), zip_name),
+        cards=len(images),
+        overflow=[idx for idx, image in enumerate(images, start=1) if image["overflow"]],
+        replies=thread_content.get("replies", []),
+        cta=thread_content.get("cta"),
+        tags=thread_content.get("tags", []),
+    )
+
+
+async def _process_topics(
+    topics: List[str],
+    generator: ThreadsCardGenerator,
+    image_generator: ImageGenerator,
+    render_mode: str,
+    semaphore: asyncio.Semaphore,
+    zip_dir: str,
+) -> List[Dict]:
+    """
+    Генерирует треды по группе тем (одна тема — обычный запрос, несколько —
+    один запрос на всю группу), рисует карточки и сохраняет ZIP; возвращает
+    записи манифеста в порядке тем
+    """
+    started = time.perf_counter()
+    records = [{"topic": topic} for topic in topics]
+    async with semaphore:
+        try:
+            if len(topics) == 1:
+                contents = [await generator.agenerate_thread_content(topics[0])]
+            else:
+                contents = await generator.agenerate_posts(topics)
+        except ThreadGenerationError as error:
+            for record in records:
+                record.update(status="error", error=str(error), error_type=type(error).__name__)
+            contents = []
+        llm_seconds = round(time.perf_counter() - started, 3)
+
+        for record, thread_content in zip(records, contents):
+            try:
+                if not thread_content or not thread_content.get("replies"):
+                    raise ValueError("Модель не вернула пост для этой темы")
+                record.update(await _save_thread(record["topic"], thread_content, image_generator, render_mode, zip_dir))
+                record["llm_seconds"] = llm_seconds
+            except (ValueError, OSError) as error:
+                record.update(status="error", error=str(error), error_type=type(error).__name__)
+    for record in records:
+        record["seconds"] = round(time.perf_counter() - started, 3)
+    return records
+
+
+async def run(args: argparse.Namespace) -> int:
+    """Обрабатывает все темы; возвращает число тем, завершившихся ошибкой"""
+    os.makedirs(args.out, exist_ok=True)
+    zip_dir = os.path.join(args.out, "zips")
+    os.makedirs(zip_dir, exist_ok=True)
+    manifest_path = os.path.join(args.out, "manifest.jsonl")
+
+    topics = load_topics(args.topics)
+    completed = _load_completed(manifest_path)
+    pending = [topic for topic in topics if topic not in completed]
+    print(f"Тем: {len(topics)}, уже готово: {len(topics) - len(pending)}, к обработке: {len(pending)}", file=sys.stderr)
+    if not pending:
+        return 0
+
+    system_prompt = DEFAULT_SYSTEM_PROMPT
+    if args.system_prompt:
+        with open(args.system_prompt, encoding="utf-8") as prompt_file:
+            system_prompt = prompt_file.read()
+
+    response_cache = None
+    if args.llm_cache != "off":
+        response_cache = LLMResponseCache(args.llm_cache_path)
+
+    bucket = AsyncTokenBucket(args.rpm / 60, capacity=args.concurrency)
+    generator = RateLimitedGenerator(
+        api_key=args.api_key,
+        system_prompt=system_prompt,
+        response_cache=response_cache,
+        replay_only=args.llm_cache == "replay",
+        base_url=args.base_url,
+        bucket=bucket,
+    )
+    image_generator = ImageGenerator(
+        fit_text=True,
+        image_format=args.image_format,
+        compress_level=args.compress_level,
+        extra_sizes=tuple(args.sizes),
+    )
+    semaphore = asyncio.Semaphore(args.concurrency)
+    metrics = get_stage_metrics()
+    if args.metrics_dir:
+        metrics.out_dir = args.metrics_dir
+
+    failures = 0
+    done_count = 0
+    groups = [pending[idx:idx + args.posts_per_request] for idx in range(0, len(pending), args.posts_per_request)]
+    tasks = [
+        asyncio.create_task(_process_topics(group, generator, image_generator, args.render_mode, semaphore, zip_dir))
+        for group in groups
+    ]
+    with open(manifest_path, "a", encoding="utf-8") as manifest_file:
+        for task in asyncio.as_completed(tasks):
+            for record in await task:
+                done_count += 1
+                manifest_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                manifest_file.flush()
+                if record["status"] != "ok":
+                    failures += 1
+                status = record.get("theme") if record["status"] == "ok" else f"ошибка: {record['error']}"
+                print(f"[{done_count}/{len(pending)}] {record['topic']} → {status} ({record['seconds']} с)", file=sys.stderr)
+            metrics.flush()
+    return failures
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Массовая генерация карточек Threads по списку тем")
+    parser.add_argument("topics", help="файл с темами, по одной на строку")
+    parser.add_argument("--out", default="bulk_output", help="каталог для ZIP-архивов и manifest.jsonl")
+    parser.add_argument("--concurrency", type=int, default=4, help="сколько тредов генерировать одновременно")
+    parser.add_argument("--rpm", type=float, default=60, help="лимит запросов к OpenAI в минуту")
+    parser.add_argument(
+        "--posts-per-request",
+        type=int,
+        default=1,
+        help="сколько постов просить в одном запросе (системный промпт отправляется один раз на группу)",
+    )
+    parser.add_argument("--api-key", default=os.getenv("OPENAI_API_KEY", ""), help="ключ OpenAI (по умолчанию OPENAI_API_KEY)")
+    parser.add_argument("--base-url", help="адрес совместимого с OpenAI сервера (например, локальной заглушки)")
+    parser.add_argument("--system-prompt", help="файл с системным промптом вместо стандартного")
+    parser.add_argument("--image-format", choices=list(CardEncoder.FORMATS), default="png")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=[name for name in CARD_SIZES if name != "square"],
+        default=[],
+        help="дополнительные размеры карточек (папки в ZIP) помимо квадрата 1080×1080",
+    )
+    parser.add_argument("--render-mode", choices=RENDER_MODES, default="auto")
+    parser.add_argument(
+        "--metrics-dir",
+        default=os.getenv("THREADS_CARDS_METRICS_DIR"),
+        help="каталог для metrics.jsonl и metrics.prom (время этапов, токены)",
+    )
+    parser.add_argument("--llm-cache", choices=["off", "record", "replay"], default="off", help="кэш ответов модели")
+    parser.add_argument(
+        "--llm-cache-path",
+        default=os.getenv("THREADS_CARDS_LLM_CACHE_PATH", "threads_cards_llm_cache.sqlite3"),
+    )
+    args = parser.parse_args(argv)
+    if not args.api_key and args.llm_cache != "replay":
+        parser.error("укажите --api-key или переменную окружения OPENAI_API_KEY")
+    if args.concurrency < 1 or args.rpm <= 0 or args.posts_per_request < 1:
+        parser.error("--concurrency, --rpm и --posts-per-request должны быть положительными")
+    return args
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = parse_args(argv)
+    try:
+        failures = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("Прервано. Повторный запуск продолжит с необработанных тем.", file=sys.stderr)
+        return 130
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""
+Локальная заглушка OpenAI API для проверки скриптов без сети и ключа
+
+Отвечает одинаковыми для одной темы постами в формате DEFAULT_SYSTEM_PROMPT
+и поддерживает те маршруты, которыми пользуются скрипты репозитория:
+
+    POST /v1/chat/completions     пост (или {"posts": [...]}) по сообщению пользователя
+    POST /v1/files                загрузка файла запросов пакетного задания
+    POST /v1/batches              создание пакетного задания
+    GET  /v1/batches              список заданий (новые первыми, limit/after)
+    GET  /v1/batches/{id}         статус: in_progress первые --polls опросов, затем --batch-status
+    GET  /v1/files/{id}/content   содержимое файла (результат задания — JSONL)
+
+Темы со словом FAIL получают ошибку 400 (в пакете — строкой результата, в
+запросе на несколько постов их слоты пропускаются), темы со словом SKIP в
+результат пакета не попадают: так проверяется учет ошибок в
+batch_pipeline.py и bulk_generate.py.
+
+Пример:
+    python openai_stub.py --port 8766
+    python batch_pipeline.py run topics.txt --out batch_output --api-key test \\
+        --base-url http://127.0.0.1:8766/v1 --poll-seconds 0.1
+"""
+
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+ROLES = ("Я", "Мама", "Психолог", "Кот", "Сосед", "ФИНАЛ")
+SLOT_LINE = re.compile(r"^(\d+)\. (.*)$", re.MULTILINE)
+
+
+def _topic_post(topic: str) -> Dict:
+    """Корректный пост по теме: тема — первые слова запроса, роли уникальны"""
+    theme = " ".join(topic.split()[:4]) or "Случайная тема"
+    return {
+        "theme": theme,
+        "replies": [{"role": role, "text": f"Реплика про «{theme}» от роли {role}."} for role in ROLES],
+        "cta": "Укажи себя👇",
+        "tags": ["#ирония", "#мемы", "#психология"],
+        "language": "ru",
+    }
+
+
+def _chat_reply(body: Dict) -> Tuple[int, Dict]:
+    """(статус, тело ответа) для запроса chat.completions"""
+    user_message = body["messages"][-1]["content"]
+    if '"posts"' in user_message:
+        # В ответе на несколько тем слоты с FAIL просто пропускаются
+        content = {"posts": [
+            {**_topic_post(topic), "slot": int(slot)}
+            for slot, topic in SLOT_LINE.findall(user_message)
+            if "FAIL" not in topic
+        ]}
+    elif "FAIL" in user_message:
+        return 400, {"error": {"message": "Заглушка: тема с FAIL", "type": "invalid_request_error"}}
+    else:
+        content = _topic_post(user_message.split("JSON.", 1)[-1].strip())
+    return 200, {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": json.dumps(content, ensure_ascii=False)},
+        }],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 200, "total_tokens": 300},
+    }
+
+
+class StubState:
+    """Файлы и пакетные задания заглушки (в памяти процесса)"""
+
+    def __init__(self, polls: int, batch_status: str):
+        self.polls = polls
+        self.batch_status = batch_status
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, content: bytes) -> str:
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = content
+        return file_id
+
+    def create_batch(self, request: Dict) -> Dict:
+        """Обрабатывает запросы сразу; статус задания открывается по мере опросов"""
+        results = []
+        for line in self.files[request["input_file_id"]].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if "SKIP" in item["body"]["messages"][-1]["content"]:
+                continue
+            status, body = _chat_reply(item["body"])
+            results.append({
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                "custom_id": item["custom_id"],
+                "response": {"status_code": status, "body": body},
+                "error": None,
+            })
+        output_file_id = self.add_file("\n".join(json.dumps(r, ensure_ascii=False) for r in results).encode("utf-8"))
+        with self.lock:
+            batch_id = f"batch-{len(self.batches) + 1}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"],
+                "completion_window": request["completion_window"],
+                "metadata": request.get("metadata"),
+                "status": "in_progress",
+                "created_at": int(time.time()),
+                "request_counts": {"total": len(results), "completed": 0, "failed": 0},
+                "_output_file_id": output_file_id,
+                "_polls": 0,
+            }
+            return self._public(self.batches[batch_id])
+
+    def retrieve_batch(self, batch_id: str) -> Dict | None:
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            batch["_polls"] += 1
+            if batch["status"] == "in_progress" and batch["_polls"] > self.polls:
+                batch["status"] = self.batch_status
+                if self.batch_status == "completed":
+                    batch["output_file_id"] = batch["_output_file_id"]
+                    total = batch["request_counts"]["total"]
+                    batch["request_counts"] = {"total": total, "completed": total, "failed": 0}
+            return self._public(batch)
+
+    def list_batches(self, limit: int, after: str | None) -> Dict:
+        """Страница списка заданий в формате курсорной пагинации OpenAI"""
+        with self.lock:
+            batches = [self._public(batch) for batch in reversed(list(self.batches.values()))]
+        if after is not None:
+            ids = [batch["id"] for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        return {
+            "object": "list",
+            "data": page,
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+            "has_more": len(batches) > limit,
+        }
+
+    @staticmethod
+    def _public(batch: Dict) -> Dict:
+        return {key: value for key, value in batch.items() if not key.startswith("_")}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Маршруты заглушки; состояние — в self.server.state"""
+
+    server: "StubServer"
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: Dict) -> None:
+        self._send(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+    def _not_found(self) -> None:
+        self._send_json(404, {"error": {"message": "Не найдено", "type": "not_found"}})
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        path = url.path
+        state = self.server.state
+        if path == "/v1/batches":
+            query = parse_qs(url.query)
+            limit = int(query.get("limit", ["20"])[0])
+            self._send_json(200, state.list_batches(limit, query.get("after", [None])[0]))
+            return
+        match = re.fullmatch(r"/v1/batches/([^/]+)", path)
+        if match:
+            batch = state.retrieve_batch(match.group(1))
+            if batch is None:
+                self._not_found()
+            else:
+                self._send_json(200, batch)
+            return
+        match = re.fullmatch(r"/v1/files/([^/]+)/content", path)
+        if match and match.group(1) in state.files:
+            self._send(200, state.files[match.group(1)], "application/jsonl")
+            return
+        self._not_found()
+
+    def do_POST(self) -> None:
+        path = urlsplit(self.path).path
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        state = self.server.state
+        if path == "/v1/chat/completions":
+            self._send_json(*_chat_reply(json.loads(body)))
+        elif path == "/v1/files":
+            content = self._multipart_file(body)
+            if content is None:
+                self._send_json(400, {"error": {"message": "Нет части file", "type": "invalid_request_error"}})
+                return
+            file_id = state.add_file(content)
+            self._send_json(200, {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": "requests.jsonl",
+                "purpose": "batch",
+                "status": "processed",
+            })
+        elif path == "/v1/batches":
+            self._send_json(200, state.create_batch(json.loads(body)))
+        else:
+            self._not_found()
+
+    def _multipart_file(self, body: bytes) -> bytes | None:
+        """Содержимое части file из multipart/form-data"""
+        header = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("latin-1")
+        message = BytesParser(policy=policy.HTTP).parsebytes(header + body)
+        if not message.is_multipart():
+            return None
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                return part.get_payload(decode=True)
+        return None
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], state: StubState, verbose: bool = False):
+        super().__init__(address, StubHandler)
+        self.state = state
+        self.verbose = verbose
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Локальная заглушка OpenAI API для проверки скриптов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--polls", type=int, default=1, help="сколько опросов задание остается in_progress")
+    parser.add_argument(
+        "--batch-status",
+        choices=["completed", "failed", "expired", "cancelled"],
+        default="completed",
+        help="финальный статус пакетных заданий",
+    )
+    parser.add_argument("--verbose", action="store_true", help="печатать каждый запрос")
+    args = parser.parse_args(argv)
+
+    server = StubServer((args.host, args.port), StubState(args.polls, args.batch_status), args.verbose)
+    print(f"Заглушка OpenAI слушает http://{args.host}:{server.server_port}/v1", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""
+HTTP-сервис рендеринга карточек без Streamlit
+
+Принимает готовый тред в формате generate_thread_content (JSON) или пакет
+тредов (JSONL, по треду на строку) и возвращает карточки: ZIP или одну
+карточку. Рабочие процессы пула запускаются и прогреваются при старте,
+шрифты и заготовки фона остаются в их памяти между запросами; карточки всех
+тредов запроса рендерятся параллельно. Если в обработке уже max_in_flight
+запросов, новые сразу получают 503 с Retry-After, а не копятся в очереди.
+
+    POST /render     тред (JSON) или пакет тредов (JSONL)
+        ?format=png|png-palette|webp|jpeg&compress_level=0-9
+        &sizes=portrait,story   дополнительные размеры (папки в ZIP)
+        &card=N                 вернуть только карточку N одного треда
+    GET  /health     состояние и загрузка (JSON)
+    GET  /metrics    метрики в текстовом формате Prometheus
+
+Пример:
+    python render_service.py --port 8080
+    curl --data-binary @thread.json "localhost:8080/render?format=webp" -o cards.zip
+    curl --data-binary @threads.jsonl localhost:8080/render -o batch.zip
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, quote, urlsplit
+
+from threads_cards.metrics import get_stage_metrics
+from threads_cards.render import CARD_SIZES, RENDER_MODES, CardEncoder, ImageGenerator
+from threads_cards.storage import images_to_zip, sanitize_filename, write_images
+
+
+class RequestError(Exception):
+    """Ошибка запроса, о которой сообщается клиенту с HTTP-статусом"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_threads(body: bytes) -> List[Dict]:
+    """
+    Разбирает тело запроса: один тред (JSON-объект), список тредов или JSONL
+
+    Каждый тред должен содержать непустой список replies с текстами реплик;
+    theme и role реплик необязательны, но если заданы — это строки.
+    """
+    try:
+        text = body.decode("utf-8")
+    except UnicodeDecodeError:
+        raise RequestError(400, "Тело запроса должно быть в UTF-8")
+    try:
+        parsed = json.loads(text)
+        threads = parsed if isinstance(parsed, list) else [parsed]
+    except json.JSONDecodeError:
+        try:
+            threads = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except json.JSONDecodeError as error:
+            raise RequestError(400, f"Некорректный JSON: {error}")
+    if not threads:
+        raise RequestError(400, "В запросе нет тредов")
+    for position, thread in enumerate(threads, start=1):
+        replies = thread.get("replies") if isinstance(thread, dict) else None
+        if not isinstance(replies, list) or not replies:
+            raise RequestError(400, f"Тред {position}: нужен непустой список replies")
+        if not all(isinstance(reply, dict) and isinstance(reply.get("text"), str) for reply in replies):
+            raise RequestError(400, f"Тред {position}: у каждой реплики должен быть текст")
+        if not all(isinstance(reply.get("role", ""), str) for reply in replies):
+            raise RequestError(400, f"Тред {position}: role реплики должна быть строкой")
+        if not isinstance(thread.get("theme", ""), str):
+            raise RequestError(400, f"Тред {position}: theme должна быть строкой")
+    return threads
+
+
+class RenderService:
+    """
+    Рендеринг тредов с ограничением числа одновременных запросов
+
+    Генераторы кэшируются по параметрам вывода, сами карточки рисует общий
+    пул процессов (get_render_executor).
+    """
+
+    def __init__(self, max_in_flight: int = 8, max_cards: int = 500, mode: str = "process"):
+        self.max_in_flight = max_in_flight
+        self.max_cards = max_cards
+        self.mode = mode
+        self.in_flight = 0
+        self.requests = {"ok": 0, "invalid": 0, "rejected": 0, "failed": 0}
+        self._generators: Dict[Tuple, ImageGenerator] = {}
+        self._lock = threading.Lock()
+
+    def generator(self, image_format: str, compress_level: int | None, sizes: Tuple[str, ...]) -> ImageGenerator:
+        key = (image_format, compress_level, sizes)
+        with self._lock:
+            if key not in self._generators:
+                self._generators[key] = ImageGenerator(
+                    fit_text=True, image_format=image_format, compress_level=compress_level, extra_sizes=sizes
+                )
+            return self._generators[key]
+
+    def warm_up(self) -> None:
+        """Запускает рабочие процессы и загружает в них шрифты до первого запроса"""
+        workers = os.cpu_count() or 1
+        self.generator("png", None, ()).render_cards([("Прогрев", "Шрифты загружены", 1, 1)] * workers, self.mode)
+
+    def try_acquire(self) -> bool:
+        """Занимает место под запрос; False, если сервис уже загружен полностью"""
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.requests["rejected"] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, outcome: str) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.requests[outcome] += 1
+
+    def render(self, threads: List[Dict], generator: ImageGenerator) -> List[List[Dict]]:
+        """Рендерит карточки всех тредов одним заходом в пул и раскладывает их по тредам"""
+        thread_jobs = [generator.thread_jobs(thread) for thread in threads]
+        total_cards = sum(len(jobs) for jobs in thread_jobs)
+        if total_cards > self.max_cards:
+            raise RequestError(413, f"Слишком много карточек в запросе: {total_cards} (лимит {self.max_cards})")
+        cards = generator.render_cards([job for jobs in thread_jobs for job in jobs], self.mode)
+        rendered, offset = [], 0
+        for jobs in thread_jobs:
+            rendered.append(cards[offset:offset + len(jobs)])
+            offset += len(jobs)
+        return rendered
+
+    def health(self) -> Dict:
+        with self._lock:
+            return {
+                "status": "ok",
+                "workers": os.cpu_count() or 1,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "requests": dict(self.requests),
+            }
+
+    def prometheus_text(self) -> str:
+        """Метрики этапов плюс загрузка и исходы запросов сервиса"""
+        health = self.health()
+        lines = [
+            "# HELP threads_cards_service_in_flight Запросы рендеринга в обработке",
+            "# TYPE threads_cards_service_in_flight gauge",
+            f"threads_cards_service_in_flight {health['in_flight']}",
+            "# HELP threads_cards_service_requests_total Запросы рендеринга по исходу",
+            "# TYPE threads_cards_service_requests_total counter",
+        ]
+        lines += [
+            f'threads_cards_service_requests_total{{outcome="{outcome}"}} {count}'
+            for outcome, count in health["requests"].items()
+        ]
+        return get_stage_metrics().prometheus_text() + "\n".join(lines) + "\n"
+
+
+def _render_options(query: Dict[str, List[str]]) -> Tuple[str, int | None, Tuple[str, ...], int | None]:
+    """Параметры вывода из строки запроса: (формат, уровень сжатия, размеры, номер карточки)"""
+    def single(name: str) -> str | None:
+        values = query.get(name)
+        return values[-1] if values else None
+
+    image_format = single("format") or "png"
+    if image_format not in CardEncoder.FORMATS:
+        raise RequestError(400, f"Неизвестный формат: {image_format}")
+    sizes = tuple(name for value in query.get("sizes", []) for name in value.split(",") if name)
+    unknown = [name for name in sizes if name not in CARD_SIZES]
+    if unknown:
+        raise RequestError(400, f"Неизвестный размер: {', '.join(unknown)}")
+    try:
+        compress_level = int(single("compress_level")) if single("compress_level") is not None else None
+        card = int(single("card")) if single("card") is not None else None
+    except ValueError:
+        raise RequestError(400, "compress_level и card должны быть целыми числами")
+    if compress_level is not None and not 0 <= compress_level <= 9:
+        raise RequestError(400, "compress_level должен быть от 0 до 9")
+    return image_format, compress_level, sizes, card
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """Маршруты сервиса; сам сервис и лимиты — в self.server"""
+
+    server: "RenderServer"
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Dict[str, str] | None = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: Dict, headers: Dict[str, str] | None = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self._send(status, body, "application/json; charset=utf-8", headers)
+
+    def do_GET(self) -> None:
+        path = urlsplit(self.path).path
+        if path == "/health":
+            self._send_json(200, self.server.service.health())
+        elif path == "/metrics":
+            self._send(200, self.server.service.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": "Не найдено"})
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/render":
+            self._send_json(404, {"error": "Не найдено"})
+            return
+        service = self.server.service
+        if not service.try_acquire():
+            self._send_json(503, {"error": "Сервис перегружен, повторите позже"}, {"Retry-After": "1"})
+            return
+        outcome = "failed"
+        try:
+            body, content_type, filename = self._render(url.query)
+            # Заголовки HTTP — latin-1, поэтому имя файла с кириллицей передается по RFC 5987
+            headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"} if filename else None
+            self._send(200, body, content_type, headers)
+            outcome = "ok"
+        except RequestError as error:
+            outcome = "invalid"
+            self._send_json(error.status, {"error": str(error)})
+        except Exception as error:
+            self._send_json(500, {"error": f"Не удалось нарисовать карточки: {error}"})
+        finally:
+            service.release(outcome)
+            get_stage_metrics().flush()
+
+    def _render(self, query_string: str) -> Tuple[bytes, str, str | None]:
+        """Возвращает (тело ответа, тип содержимого, имя файла для скачивания)"""
+        image_format, compress_level, sizes, card = _render_options(parse_qs(query_string))
+        try:
+            length = int(self.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError):
+            raise RequestError(411, "Нужен заголовок Content-Length")
+        if length > self.server.max_body_bytes:
+            raise RequestError(413, f"Тело запроса больше {self.server.max_body_bytes} байт")
+        threads = parse_threads(self.rfile.read(length))
+        if card is not None and (len(threads) != 1 or not 1 <= card <= len(threads[0]["replies"])):
+            raise RequestError(400, "card — номер карточки одного треда, начиная с 1")
+
+        service = self.server.service
+        with get_stage_metrics().timer("service_request"):
+            generator = service.generator(image_format, compress_level, sizes)
+            if card is not None:
+                # Нумерация и счетчик — как у полного треда, рисуется только одна карточка
+                image_info = generator.render_cards([generator.thread_jobs(threads[0])[card - 1]], service.mode)[0]
+                return image_info["bytes"], image_info["mime"], None
+            rendered = service.render(threads, generator)
+            if len(threads) == 1:
+                theme = threads[0].get("theme") or "thread"
+                return images_to_zip(rendered[0], theme).getvalue(), "application/zip", f"{sanitize_filename(theme)}.zip"
+            buffer = io.BytesIO()
+            with get_stage_metrics().timer("zip"), zipfile.ZipFile(buffer, "w") as zip_file:
+                for position, (thread, images) in enumerate(zip(threads, rendered), start=1):
+                    theme = thread.get("theme") or "thread"
+                    write_images(zip_file, images, theme, folder=f"{position:03d}_{sanitize_filename(theme)}/")
+            return buffer.getvalue(), "application/zip", "threads.zip"
+
+
+class RenderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: RenderService, max_body_bytes: int):
+        super().__init__(address, RenderHandler)
+        self.service = service
+        self.max_body_bytes = max_body_bytes
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="HTTP-сервис рендеринга карточек Threads")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-in-flight", type=int, default=8, help="сколько запросов обрабатывать одновременно")
+    parser.add_argument("--max-cards", type=int, default=500, help="лимит карточек в одном запросе")
+    parser.add_argument("--max-body-mb", type=float, default=16, help="лимит размера тела запроса")
+    parser.add_argument("--render-mode", choices=RENDER_MODES, default="process")
+    parser.add_argument(
+        "--metrics-dir",
+        default=os.getenv("THREADS_CARDS_METRICS_DIR"),
+        help="каталог для metrics.jsonl и metrics.prom (в дополнение к маршруту /metrics)",
+    )
+    args = parser.parse_args(argv)
+    if args.max_in_flight < 1 or args.max_cards < 1 or args.max_body_mb <= 0:
+        parser.error("--max-in-flight, --max-cards и --max-body-mb должны быть положительными")
+    return args
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = parse_args(argv)
+    if args.metrics_dir:
+        get_stage_metrics().out_dir = args.metrics_dir
+    service = RenderService(args.max_in_flight, args.max_cards, args.render_mode)
+    service.warm_up()
+    server = RenderServer((args.host, args.port), service, int(args.max_body_mb * 1024 * 1024))
+    print(f"Сервис рендеринга слушает http://{args.host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        get_stage_metrics().flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
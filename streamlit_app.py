@@ -1,413 +1,97 @@
-import streamlit as st
+import functools
 import os
-import json
-import zipfile
-import io
+import time
 import uuid
-import re
-from datetime import datetime
-from typing import List, Dict
-from openai import OpenAI
-from PIL import Image, ImageDraw, ImageFont
-
-DEFAULT_SYSTEM_PROMPT = """🧠 ПРОМПТ ДЛЯ ИИ-SMM-АГЕНТА
-
-Цель: Генерировать вирусные карточки Threads в формате "Типы экспертов отвечают на любую проблему" в виде валидного JSON.
-
-📄 Формат вывода - строго валидный JSON:
-{
-  "id": "<уникальный_идентификатор>",
-  "theme": "<короткая тема / проблема>",
-  "replies": [
-    {
-      "role": "<роль или тип говорящего>",
-      "text": "<форматированный текст реплики>"
-    }
-  ],
-  "cta": "<призыв к действию>",
-  "tags": ["#тег1", "#тег2", "#тег3"],
-  "language": "ru"
-}
-
-⚙️ Технические требования:
-* Ответ строго JSON, без комментариев, без текста до или после
-* replies содержит от 6 до 8 реплик
-* Первая реплика — тема/проблема ("Я" или "Клиент")
-* Последняя — панчлайн ("ФИНАЛ" или какой-нибудь персонаж/эксперт)
-* Все роли уникальны внутри одного поста
-* theme — короткая (1–4 слова)
-* language всегда "ru"
-
-🎭 Стиль и содержание:
-* Тон: юмористический
-* Настроение: меньше депрессии — больше иронии, сатиры, бытового абсурда
-* Последняя реплика — панчлайн: короткая, неожиданная
-
-Типы персонажей:
-Выбирай экспертов/персонажей из жизни по заданной теме.
-Используй разных “экспертов” в каждой реплике.
-Можно добавлять абсурдные (“ДУХ {...}”, “Wi-Fi”, “ГОСУСЛУГИ”, “СОСЕД”).
-
-✍️ Форматирование текста:
-* жирный для эмоциональных слов
-* *курсив* для подчеркивания
-* Используй простой текст без HTML
-
-🔥 Правила панчлайна:
-* Последняя реплика короткая (1-3 строки)
-* Может быть полностью капсом
-* Обязательно выделить ключевое слово
-
-📢 CTA (выбери один):
-* "Укажи себя👇"
-
-🏷️ Хештеги: 3–5 штук (#ирония, #threadsюмор, #психология, #мемы, #коучинг)
-
-🚫 Без насилия, дискриминации, политики, откровенного контента."""
-
-# ============================================       
-# КЛАССЫ ДЛЯ ГЕНЕРАЦИИ
-# ============================================
-
-class ThreadsCardGenerator:
-    """ИИ-агент для генерации вирусных карточек Threads"""
-    
-    def __init__(self, api_key: str, system_prompt: str | None = None):
-        self.client = OpenAI(api_key=api_key)
-        prompt = system_prompt or self._load_system_prompt()
-        self.system_prompt = prompt.strip() if isinstance(prompt, str) else DEFAULT_SYSTEM_PROMPT
-        
-    def _load_system_prompt(self) -> str:
-        """Загружает системный промпт для ИИ"""
-        return DEFAULT_SYSTEM_PROMPT
-
-    def generate_thread_content(self, topic: str = None) -> Dict:
-        """
-        Генерирует контент для карточек через OpenAI API
-        
-        Args:
-            topic: Опциональная тема для генерации
-            
-        Returns:
-            Dict с темой и репликами
-        """
-        user_message = "Сгенерируй новый вирусный пост в формате JSON."
-        if topic:
-            user_message += f" {topic}"
-            
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.9,
-                response_format={"type": "json_object"}
-            )
-            
-            content = json.loads(response.choices[0].message.content)
-            
-            # Добавляем ID если отсутствует
-            if "id" not in content:
-                content["id"] = f"post_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
-                
-            return content
-            
-        except Exception as e:
-            raise Exception(f"Ошибка при генерации контента: {str(e)}")
-
-
-class ImageGenerator:
-    """Генератор изображений с наложением текста"""
-    
-    def __init__(self, width: int = 1080, height: int = 1080):
-        self.width = width
-        self.height = height
-        self.colors = {
-            'background': '#1a1a2e',
-            'role': '#e94560',
-            'text': '#ffffff',
-            'accent': '#0f3460'
-        }
-        
-    def _get_font(self, size: int, bold: bool = False):
-        """Возвращает шрифт DejaVu Sans (поддерживает кириллицу и латиницу)"""
-        font_name = "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf"
-        try:
-            return ImageFont.truetype(font_name, size)
-        except OSError:
-            return ImageFont.load_default()
-
-    def _format_sentences(self, text: str) -> str:
-        """Убирает лишние пробелы перед знаками препинания и переносит предложения на новую строку"""
-        text = re.sub(r'\s+([,.;!?])', r'\1', text)
-        text = re.sub(r'\s{2,}', ' ', text)
-        text = re.sub(r'([.!?])\s+(?=[^\s])', r'\1\n', text)
-        return text.strip()
-    
-    def _parse_markdown(self, text: str) -> List[tuple]:
-        """
-        Простой парсер markdown для **жирного** и *курсива*
-        Возвращает список кортежей (текст, стиль)
-        """
-        result = []
-        i = 0
-        current_text = ""
-        
-        while i < len(text):
-            if i < len(text) - 1 and text[i:i+2] == '**':
-                if current_text:
-                    result.append((current_text, 'normal'))
-                    current_text = ""
-                # Ищем закрывающие **
-                end = text.find('**', i + 2)
-                if end != -1:
-                    content = text[i+2:end]
-                    # Удаляем пробелы перед знаками препинания
-                    content = re.sub(r'\s+([,.;!?])', r'\1', content)
-                    result.append((content, 'bold'))
-                    i = end + 2
-                else:
-                    current_text += text[i]
-                    i += 1
-            elif text[i] == '*':
-                if current_text:
-                    result.append((current_text, 'normal'))
-                    current_text = ""
-                # Ищем закрывающий *
-                end = text.find('*', i + 1)
-                if end != -1:
-                    content = text[i+1:end]
-                    content = re.sub(r'\s+([,.;!?])', r'\1', content)
-                    result.append((content, 'italic'))
-                    i = end + 1
-                else:
-                    current_text += text[i]
-                    i += 1
-            else:
-                current_text += text[i]
-                i += 1
-        
-        if current_text:
-            clean_text = re.sub(r'\s+([,.;!?])', r'\1', current_text)
-            result.append((clean_text, 'normal'))
-            
-        return result if result else [(re.sub(r'\s+([,.;!?])', r'\1', text), 'normal')]
-    
-    def _should_keep_with_next(self, word: str) -> bool:
-        """Проверяет, нужно ли держать слово вместе со следующим"""
-        short_words = {'и', 'в', 'на', 'с', 'по', 'за', 'из', 'о', 'у', 'к', 'до', 'от', 'не'}
-        return word.lower() in short_words or len(word) <= 2
-    
-    def _ends_with_punctuation(self, word: str) -> bool:
-        """Проверяет, заканчивается ли слово знаком препинания"""
-        return word and word[-1] in '.,!?;:—-'
-    
-    def _split_word_and_punctuation(self, word: str) -> tuple:
-        """Отделяет знаки препинания от слова"""
-        if not word:
-            return '', ''
-        
-        punctuation = ''
-        text = word
-        
-        # Собираем знаки препинания с конца
-        while text and text[-1] in '.,!?;:—-':
-            punctuation = text[-1] + punctuation
-            text = text[:-1]
-        
-        return text, punctuation
-    
-    def create_card(self, role: str, text: str, card_number: int, total_cards: int) -> Image.Image:
-        """Создает одну карточку с репликой"""
-        img = Image.new('RGB', (self.width, self.height), self.colors['background'])
-        draw = ImageDraw.Draw(img)
-        
-        # Шрифты
-        role_font = self._get_font(60, bold=True)
-        text_font = self._get_font(45)
-        text_font_bold = self._get_font(45, bold=True)
-        counter_font = self._get_font(30)
-        
-        padding = 160
-        y_position = padding
-        
-        # Рисуем роль
-        role_bbox = draw.textbbox((0, 0), role, font=role_font)
-        role_width = role_bbox[2] - role_bbox[0]
-        role_x = (self.width - role_width) // 2
-        
-        draw.text((role_x, y_position), role, fill=self.colors['role'], font=role_font)
-        y_position += (role_bbox[3] - role_bbox[1]) + 60
-        
-        # Разделитель
-        line_margin = 200
-        draw.line([(line_margin, y_position), (self.width - line_margin, y_position)], 
-                  fill=self.colors['accent'], width=3)
-        y_position += 120
-        
-        # Парсим и рисуем текст с форматированием
-        text = self._format_sentences(text)
-        parsed_text = self._parse_markdown(text)
-        max_width = self.width - (padding * 2)
-        
-        # Собираем все сегменты в единый список слов с их стилями
-        word_segments = []
-        for segment, style in parsed_text:
-            parts = segment.split('\n')
-            for part_index, part in enumerate(parts):
-                if part.strip():
-                    words = part.split()
-                    for word in words:
-                        word_text, punctuation = self._split_word_and_punctuation(word)
-                        if word_text:
-                            word_segments.append((word_text, style, punctuation))
-                        elif punctuation:
-                            word_segments.append(('', style, punctuation))
-                if part_index < len(parts) - 1:
-                    word_segments.append((None, 'newline', ''))
-        
-        # Формируем строки с учетом правил
-        lines = []
-        current_line = []
-        i = 0
-        
-        while i < len(word_segments):
-            word_text, style, punctuation = word_segments[i]
-
-            if style == 'newline':
-                if current_line:
-                    lines.append(current_line)
-                    current_line = []
-                i += 1
-                continue
-            
-            # Проверяем, поместится ли слово в текущую строку
-            full_word = word_text + punctuation
-            test_line = current_line + [(full_word, style)]
-            test_text = ' '.join([w for w, _ in test_line])
-            
-            test_font = text_font_bold if style == 'bold' else text_font
-            bbox = draw.textbbox((0, 0), test_text, font=test_font)
-            line_width = bbox[2] - bbox[0]
-            
-            if line_width <= max_width:
-                current_line.append((full_word, style))
-                i += 1
-            else:
-                if current_line:
-                    last_word = current_line[-1][0]
-                    
-                    if self._should_keep_with_next(last_word.rstrip('.,!?;:—-')):
-                        if len(current_line) > 1:
-                            lines.append(current_line[:-1])
-                            current_line = [current_line[-1], (full_word, style)]
-                            i += 1
-                        else:
-                            lines.append(current_line)
-                            current_line = [(full_word, style)]
-                            i += 1
-                    else:
-                        lines.append(current_line)
-                        current_line = [(full_word, style)]
-                        i += 1
-                else:
-                    current_line = [(full_word, style)]
-                    i += 1
-        
-        if current_line:
-            lines.append(current_line)
-
-        punctuation_regex = re.compile(r'\s+([,.;!?])')
-        cleaned_lines = []
-        for line in lines:
-            cleaned_line = []
-            for word, style in line:
-                cleaned_word = punctuation_regex.sub(r'\1', word)
-                cleaned_line.append((cleaned_word, style))
-            cleaned_lines.append(cleaned_line)
-        lines = cleaned_lines
-
-        # Рисуем строки
-        for line_segments in lines:
-            line_text = ' '.join([word for word, _ in line_segments])
-            bbox = draw.textbbox((0, 0), line_text, font=text_font)
-            line_width = bbox[2] - bbox[0]
-            x = (self.width - line_width) // 2
-            for idx, (word, style) in enumerate(line_segments):
-                current_font = text_font_bold if style == 'bold' else text_font
-                draw.text((x, y_position), word, fill=self.colors['text'], font=current_font)
-                word_bbox = draw.textbbox((0, 0), word, font=current_font)
-                word_width = word_bbox[2] - word_bbox[0]
-                x += word_width
-                if idx < len(line_segments) - 1:
-                    next_word = line_segments[idx + 1][0]
-                    if not (style in ('bold', 'italic') and next_word in {'.', ',', '!', ':', ';'}):
-                        space_bbox = draw.textbbox((0, 0), ' ', font=current_font)
-                        x += space_bbox[2] - space_bbox[0]
-            
-            bbox = draw.textbbox((0, 0), 'Ay', font=text_font)
-            y_position += (bbox[3] - bbox[1]) + 20
-        
-        # Счетчик карточек внизу
-        counter_text = f"{card_number}/{total_cards}"
-        counter_bbox = draw.textbbox((0, 0), counter_text, font=counter_font)
-        counter_x = (self.width - (counter_bbox[2] - counter_bbox[0])) // 2
-        counter_y = self.height - padding
-        
-        draw.text((counter_x, counter_y), counter_text, 
-                  fill=self.colors['accent'], font=counter_font)
-        
-        return img
-
-
-# ============================================       
-# STREAMLIT-ПРИЛОЖЕНИЕ
-# ============================================
+from typing import Dict, List
+
+import streamlit as st
+
+from threads_cards.errors import GenerationAuthError
+from threads_cards.jobs import get_generation_queue, run_generation_job
+from threads_cards.llm import ThreadsCardGenerator, get_llm_cache
+from threads_cards.metrics import get_stage_metrics
+from threads_cards.prompts import DEFAULT_SYSTEM_PROMPT
+from threads_cards.render import PREVIEW_WIDTH, ImageGenerator
+from threads_cards.storage import (
+    batch_content_hash,
+    batch_image_generator,
+    batch_zip,
+    get_batch_archive,
+    get_card_render_cache,
+    image_bytes,
+    render_thread_incremental,
+    restore_images,
+    sanitize_filename,
+)
+from threads_cards.topics import TopicIndex
 
 
 def _init_session_vars() -> None:
     """Инициализирует переменные в session_state"""
     defaults = {
         "api_key": os.getenv("OPENAI_API_KEY", ""),
-        "random_topics_history": [],
         "generated_batches": [],
-        "is_generating": False,
         "batch_indices": {},
         "system_prompt": DEFAULT_SYSTEM_PROMPT,
+        "image_format": "png",
+        "compress_level": 6,
+        "extra_sizes": [],
+        "archive_page": 0,
+        "stream_generation": True,
+        "llm_cache_mode": os.getenv("THREADS_CARDS_LLM_CACHE", "off"),
+        "show_metrics": False,
     }
     for key, value in defaults.items():
         if key not in st.session_state:
             # Используем копию для изменяемых структур
             st.session_state[key] = value[:] if isinstance(value, list) else value
+    if "topic_index" not in st.session_state:
+        st.session_state["topic_index"] = TopicIndex()
+
+
+def _session_owner() -> str:
+    """Идентификатор владельца заданий; хранится в адресе страницы и переживает переподключение"""
+    owner = st.query_params.get("session")
+    if not owner:
+        owner = uuid.uuid4().hex[:16]
+        st.query_params["session"] = owner
+    return owner
+
+
+def _job_error_message(error: Exception) -> str:
+    if isinstance(error, GenerationAuthError):
+        return "OpenAI отклонил API Key. Проверьте ключ в настройках."
+    return f"Не удалось завершить генерацию: {error}"
+
+
+@st.fragment(run_every=1.0)
+def _render_job_progress(owner: str) -> None:
+    """Прогресс фоновых генераций; опрашивается раз в секунду, пока они идут"""
+    jobs = get_generation_queue().jobs(owner)
+    if not any(job.active for job in jobs):
+        # Все завершились — полный перезапуск заберет результаты
+        st.rerun()
+    for job in jobs:
+        label = job.topic or "Случайная тема"
+        if job.total:
+            st.progress(job.done / job.total, text=f"{label} · {job.stage} {job.done}/{job.total}")
+        else:
+            steps = f" ({job.done})" if job.done else ""
+            st.progress(0.0, text=f"{label} · {job.stage}{steps}")
+        if job.previews and job.active:
+            # Карточки, уже нарисованные по ходу ответа модели
+            preview_cols = st.columns(4)
+            for idx, (role, blob) in enumerate(list(job.previews)):
+                try:
+                    image_data = image_bytes({"blob": blob})
+                except KeyError:
+                    continue
+                with preview_cols[idx % 4]:
+                    st.image(image_data, caption=role, width="stretch")
 
 
-def _sanitize_filename(value: str) -> str:
-    """Создает безопасное имя файла на основе темы"""
-    safe_chars = "_- "
-    cleaned = "".join(ch if ch.isalnum() or ch in safe_chars else "_" for ch in value)
-    collapsed = "_".join(filter(None, cleaned.split()))
-    return collapsed[:80] or "thread"
-
-
-def _build_random_topic_request(history: List[str]) -> str:
-    """Формирует текст запроса для случайной темы"""
-    if not history:
-        return "Любая тема, которая точно удивит"
-    history_text = ", ".join(history)
-    return f"Любая, кроме {history_text}"
-
-
-def _images_to_zip(images: List[Dict], theme: str) -> io.BytesIO:
-    """Упаковывает изображения одной генерации в ZIP"""
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for idx, image_info in enumerate(images, start=1):
-            filename = f"{_sanitize_filename(theme)}_{idx:02d}_{image_info['role']}.png"
-            zip_file.writestr(filename, image_info["bytes"])
-    zip_buffer.seek(0)
-    return zip_buffer
+# Сколько последних подборок показывать в сессии (остальные — в архиве)
+MAX_SESSION_BATCHES = 5
 
 
 def _shift_batch_index(batch_id: str, delta: int, total: int) -> None:
@@ -418,8 +102,15 @@ def _shift_batch_index(batch_id: str, delta: int, total: int) -> None:
     indices[batch_id] = new_idx
 
 
-def _render_image_viewer(batch_id: str, theme: str, images: List[Dict]) -> None:
-    """Отображает изображения с переключением вперед/назад"""
+@st.fragment
+def _render_image_viewer(batch: Dict, key_prefix: str = "") -> None:
+    """
+    Отображает изображения с переключением вперед/назад
+
+    Просмотрщик — фрагмент: клик по ◀/▶ перезапускает только его, а не весь
+    скрипт с остальными подборками, архивом и сайдбаром.
+    """
+    batch_id, theme, images = batch["id"], batch["theme"], batch["images"]
     indices = st.session_state["batch_indices"]
     total = len(images)
     if total == 0:
@@ -439,7 +130,7 @@ def _render_image_viewer(batch_id: str, theme: str, images: List[Dict]) -> None:
         with button_col:
             st.button(
                 "◀",
-                key=f"prev_{batch_id}",
+                key=f"{key_prefix}prev_{batch_id}",
                 disabled=current_idx <= 0,
                 use_container_width=True,
                 on_click=_shift_batch_index,
@@ -449,7 +140,7 @@ def _render_image_viewer(batch_id: str, theme: str, images: List[Dict]) -> None:
         with button_col_right:
             st.button(
                 "▶",
-                key=f"next_{batch_id}",
+                key=f"{key_prefix}next_{batch_id}",
                 disabled=current_idx >= total - 1,
                 use_container_width=True,
                 on_click=_shift_batch_index,
@@ -457,12 +148,174 @@ def _render_image_viewer(batch_id: str, theme: str, images: List[Dict]) -> None:
             )
 
     current_idx = indices[batch_id]
+    # Вытесненная из хранилища карточка перерисовывается по параметрам подборки
+    restore_images(batch, [current_idx])
     current_image = images[current_idx]
 
     with image_col:
         caption = f"{current_idx + 1}/{total} · {current_image['role']}"
+        if current_image.get("font_size"):
+            caption += f" · шрифт {current_image['font_size']}px"
+        if current_image.get("size_bytes"):
+            caption += f" · {current_image['format'].upper()} {current_image['size_bytes'] / 1024:.0f} КБ"
+        if current_image.get("overflow"):
+            caption += " · ⚠️ текст не поместился"
         display_width = max(1, current_image.get("width", 1080) // 2)
-        st.image(current_image["bytes"], caption=caption, width=display_width)
+        # Превью уже нужного размера — в браузер не уходит полноразмерная карточка
+        preview = current_image.get("variants", {}).get("preview")
+        st.image(image_bytes(preview or current_image), caption=caption, width=display_width)
+
+
+def _apply_batch_edit(batch: Dict, replies: List[Dict], colors: Dict[str, str], cta: str) -> int:
+    """
+    Применяет правки к подборке: перерисовываются только карточки с измененными
+    входами, ZIP потом собирается из готовых карточек. Возвращает число
+    перерисованных карточек.
+    """
+    image_generator = batch_image_generator(batch, colors=colors)
+    # Подборка могла прийти из архива после перезапуска — ее карточки тоже годятся как кэш
+    render_cache = get_card_render_cache()
+    for image_info in batch["images"]:
+        render_cache.put(image_info)
+
+    images, rerendered = render_thread_incremental(image_generator, {"replies": replies})
+    batch.update(
+        replies=replies,
+        images=images,
+        cta=cta,
+        colors=dict(image_generator.colors),
+        content_hash=batch_content_hash(images, batch["theme"]),
+    )
+    get_batch_archive().save(batch)
+    return rerendered
+
+
+def _render_batch_editor(batch: Dict) -> None:
+    """Форма правки реплик, цветов и CTA подборки"""
+    colors = {**ImageGenerator.DEFAULT_COLORS, **(batch.get("colors") or {})}
+    color_labels = {"background": "Фон", "role": "Роль", "text": "Текст", "accent": "Счетчик"}
+    with st.expander("Редактировать подборку", expanded=False):
+        with st.form(key=f"edit_{batch['id']}"):
+            color_cols = st.columns(len(color_labels))
+            new_colors = {}
+            for col, (name, label) in zip(color_cols, color_labels.items()):
+                with col:
+                    new_colors[name] = st.color_picker(label, colors[name], key=f"edit_{batch['id']}_color_{name}")
+            cta = st.text_input("CTA", batch.get("cta") or "", key=f"edit_{batch['id']}_cta")
+
+            replies = []
+            for idx, reply in enumerate(batch["replies"], start=1):
+                role_col, text_col = st.columns([1, 3])
+                with role_col:
+                    role = st.text_input(f"Роль {idx}", reply.get("role", ""), key=f"edit_{batch['id']}_role_{idx}")
+                with text_col:
+                    text = st.text_area(f"Текст {idx}", reply.get("text", ""), height=90, key=f"edit_{batch['id']}_text_{idx}")
+                replies.append({**reply, "role": role.strip() or reply.get("role", ""), "text": text})
+
+            submitted = st.form_submit_button("Применить правки")
+
+        if submitted:
+            started = time.perf_counter()
+            rerendered = _apply_batch_edit(batch, replies, new_colors, cta.strip())
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            st.success(f"Перерисовано карточек: {rerendered} из {len(replies)} за {elapsed_ms:.0f} мс")
+
+
+def _render_batch(batch: Dict, key_prefix: str = "") -> None:
+    """Отображает одну подборку: метаданные, просмотр карточек и кнопку скачивания"""
+    # Правки применяются до отрисовки просмотрщика, чтобы он сразу показал новые карточки
+    if not key_prefix:
+        _render_batch_editor(batch)
+
+    # Ключи виджетов строятся из собственного ID подборки: ID от модели может повторяться
+    meta_text = (
+        f"ID: `{batch['id']}` · ID модели: `{batch.get('model_id') or '—'}` · "
+        f"Создано: {batch['timestamp']} · CTA: {batch.get('cta', 'не задано')}"
+    )
+    st.caption(meta_text)
+
+    if batch.get("tags"):
+        st.caption("Теги: " + " ".join(batch["tags"]))
+
+    _render_image_viewer(batch, key_prefix)
+
+    download_label = f"Скачать ZIP для темы «{batch['theme']}»"
+    st.download_button(
+        download_label,
+        data=functools.partial(batch_zip, batch),
+        file_name=f"{sanitize_filename(batch['theme'])}.zip",
+        mime="application/zip",
+        key=f"{key_prefix}download_{batch['id']}",
+        on_click="ignore",
+    )
+    st.write("---")
+
+
+def _render_archive() -> None:
+    """Постраничный просмотр архива подборок с поиском по теме и тегу"""
+    archive = get_batch_archive()
+    page_size = 5
+
+    search_col, tag_col = st.columns([2, 1])
+    with search_col:
+        theme_query = st.text_input("Поиск по теме", key="archive_theme_query")
+    with tag_col:
+        tag_query = st.selectbox("Тег", options=[""] + archive.tags(), key="archive_tag")
+
+    filters = (theme_query, tag_query)
+    if st.session_state.get("archive_filters") != filters:
+        st.session_state["archive_filters"] = filters
+        st.session_state["archive_page"] = 0
+
+    page = st.session_state["archive_page"]
+    batches, total = archive.query(theme_query, tag_query, page, page_size)
+    page_count = max(1, -(-total // page_size))
+
+    if not batches:
+        st.info("В архиве пока нет подборок по этому запросу.")
+        return
+
+    prev_col, info_col, next_col = st.columns([1, 3, 1])
+    with prev_col:
+        if st.button("← Новее", disabled=page <= 0, key="archive_prev"):
+            st.session_state["archive_page"] = page - 1
+            st.rerun()
+    with info_col:
+        st.caption(f"Страница {page + 1} из {page_count} · найдено подборок: {total}")
+    with next_col:
+        if st.button("Старше →", disabled=page >= page_count - 1, key="archive_next"):
+            st.session_state["archive_page"] = page + 1
+            st.rerun()
+
+    for batch in batches:
+        # Описания карточек загружаются только для подборок текущей страницы
+        batch["images"] = archive.load_images(batch["id"])
+        with st.container():
+            _render_batch(batch, key_prefix="archive_")
+
+
+def _render_metrics_panel() -> None:
+    """Сводка StageMetrics в сайдбаре"""
+    metrics = get_stage_metrics()
+    st.subheader("Метрики производительности")
+    rows = metrics.summary()
+    if not rows:
+        st.info("Замеров пока нет — запустите генерацию.")
+        return
+    st.dataframe(rows, hide_index=True, width="stretch")
+    tokens = metrics.tokens
+    st.caption(f"Токены: запрос {tokens['prompt']}, ответ {tokens['completion']}, всего {tokens['total']}")
+    rss = metrics.peak_rss_bytes()
+    if rss is not None:
+        st.caption(f"Пиковая память процесса: {rss / 1024 / 1024:.0f} МБ")
+    st.download_button(
+        "Скачать метрики (Prometheus)",
+        data=metrics.prometheus_text(),
+        file_name="metrics.prom",
+        mime="text/plain",
+        key="download_metrics",
+        on_click="ignore",
+    )
 
 
 def main() -> None:
@@ -495,7 +348,11 @@ def main() -> None:
             "Системный промпт",
             value=st.session_state.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
             height=420,
-            help="Эта инструкция передается модели. Можно настроить под свои задачи.",
+            help=(
+                "Эта инструкция передается модели. Можно настроить под свои задачи. "
+                "Формат стандартного промпта (6–8 реплик на русском, CTA, теги) проверяется "
+                "и исправляется; со своим промптом проверяется только наличие реплик."
+            ),
             key="prompt_editor",
         )
         apply_col, hint_col = st.columns([1, 1])
@@ -508,15 +365,75 @@ def main() -> None:
             st.session_state["system_prompt"] = prompt_input or DEFAULT_SYSTEM_PROMPT
             st.success("Промпт обновлен.")
 
+        st.subheader("Изображения")
+        format_labels = {
+            "png": "PNG",
+            "png-palette": "PNG с палитрой (компактный)",
+            "webp": "WebP без потерь",
+            "jpeg": "JPEG",
+        }
+        st.selectbox(
+            "Формат",
+            options=list(format_labels),
+            format_func=format_labels.get,
+            key="image_format",
+        )
+        st.slider(
+            "Уровень сжатия",
+            min_value=0,
+            max_value=9,
+            key="compress_level",
+            help="Меньше — быстрее кодирование, больше — меньше файл (PNG и WebP).",
+        )
+        size_labels = {
+            "portrait": "Портрет 1080×1350",
+            "story": "Сторис 1080×1920",
+        }
+        st.multiselect(
+            "Дополнительные размеры",
+            options=list(size_labels),
+            format_func=size_labels.get,
+            key="extra_sizes",
+            help="Рисуются из той же верстки, что и квадратная карточка, и попадают в ZIP отдельными папками.",
+        )
+
+        st.checkbox(
+            "Показывать карточки по мере генерации",
+            key="stream_generation",
+            help="Ответ модели читается потоком, каждая карточка рисуется и показывается сразу после своей реплики.",
+        )
+
+        cache_labels = {
+            "off": "Выключен",
+            "record": "Запоминать и повторять ответы",
+            "replay": "Только записанные ответы (офлайн)",
+        }
+        st.selectbox(
+            "Кэш ответов модели",
+            options=list(cache_labels),
+            format_func=cache_labels.get,
+            key="llm_cache_mode",
+            help="Повтор записанных ответов позволяет перерисовывать карточки без обращения к OpenAI.",
+        )
+
+        st.checkbox(
+            "Показывать метрики производительности",
+            key="show_metrics",
+            help="Время этапов (модель, верстка, отрисовка, кодирование, ZIP), токены и память процесса.",
+        )
+
         st.subheader("История случайных тем")
-        history = st.session_state.get("random_topics_history", [])
-        if history:
-            st.markdown("\n".join(f"- {topic}" for topic in history))
+        topic_index = st.session_state["topic_index"]
+        if len(topic_index):
+            recent = topic_index.themes[-20:]
+            st.markdown("\n".join(f"- {topic}" for topic in reversed(recent)))
+            if len(topic_index) > len(recent):
+                st.caption(f"Показаны последние {len(recent)} из {len(topic_index)} тем.")
         else:
             st.info("История пока пуста — сгенерируйте первую случайную тему.")
 
         if st.button("Очистить историю случайных тем", type="secondary"):
-            st.session_state["random_topics_history"] = []
+            topic_index.clear()
             st.success("История случайных тем очищена.")
 
     user_topic = st.text_input(
@@ -524,82 +441,48 @@ def main() -> None:
         placeholder="Введите тему или оставьте поле пустым для случайной генерации",
     ).strip()
 
-    generate_disabled = st.session_state["is_generating"]
-    generate_button = st.button(
-        "Сгенерировать карточки",
-        type="primary",
-        disabled=generate_disabled,
-    )
+    generate_button = st.button("Сгенерировать карточки", type="primary")
 
-    if generate_button and not st.session_state["is_generating"]:
-        if not st.session_state["api_key"]:
+    owner = _session_owner()
+    queue = get_generation_queue()
+    if generate_button:
+        replay_only = st.session_state["llm_cache_mode"] == "replay"
+        if not st.session_state["api_key"] and not replay_only:
             st.warning("Укажите OpenAI API Key в настройках, чтобы продолжить.")
         else:
-            st.session_state["is_generating"] = True
-            with st.spinner("Идет генерация контента и изображений..."):
-                try:
-                    topic_used = user_topic
-                    used_random_topic = False
-
-                    if not topic_used:
-                        topic_used = _build_random_topic_request(st.session_state["random_topics_history"])
-                        used_random_topic = True
-
-                    content_generator = ThreadsCardGenerator(
-                        api_key=st.session_state["api_key"],
-                        system_prompt=st.session_state.get("system_prompt"),
-                    )
-                    thread_content = content_generator.generate_thread_content(topic_used)
-
-                    replies = thread_content.get("replies", [])
-                    if not replies:
-                        raise ValueError("Модель вернула пустой список реплик. Попробуйте снова.")
-
-                    image_generator = ImageGenerator()
-                    total_cards = len(replies)
-                    generated_images = []
-
-                    for idx, reply in enumerate(replies, start=1):
-                        role = reply.get("role", f"Реплика {idx}")
-                        text = reply.get("text", "")
-                        card_img = image_generator.create_card(role, text, idx, total_cards)
-                        buffer = io.BytesIO()
-                        card_img.save(buffer, format="PNG")
-                        generated_images.append(
-                            {
-                                "role": role,
-                                "text": text,
-                                "bytes": buffer.getvalue(),
-                                "width": card_img.width,
-                                "height": card_img.height,
-                            }
-                        )
-
-                    theme = thread_content.get("theme", topic_used)
-                    batch_id = thread_content.get("id") or f"thread_{uuid.uuid4().hex[:8]}"
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                    batch_payload = {
-                        "id": batch_id,
-                        "theme": theme,
-                        "topic_used": topic_used,
-                        "replies": replies,
-                        "images": generated_images,
-                        "cta": thread_content.get("cta"),
-                        "tags": thread_content.get("tags", []),
-                        "timestamp": timestamp,
-                    }
-
-                    st.session_state["generated_batches"] = [batch_payload]
-                    st.session_state["batch_indices"] = {batch_id: 0}
-
-                    if used_random_topic and theme not in st.session_state["random_topics_history"]:
-                        st.session_state["random_topics_history"].append(theme)
-
-                except Exception as error:
-                    st.error(f"Не удалось завершить генерацию: {error}")
-                finally:
-                    st.session_state["is_generating"] = False
+            content_generator = ThreadsCardGenerator(
+                api_key=st.session_state["api_key"],
+                system_prompt=st.session_state.get("system_prompt"),
+                response_cache=get_llm_cache() if st.session_state["llm_cache_mode"] != "off" else None,
+                replay_only=replay_only,
+            )
+            image_generator = ImageGenerator(
+                fit_text=True,
+                image_format=st.session_state["image_format"],
+                compress_level=st.session_state["compress_level"],
+                extra_sizes=tuple(st.session_state["extra_sizes"]),
+                preview_width=PREVIEW_WIDTH,
+            )
+            # Генерация идет в фоне: можно ставить следующие темы, не дожидаясь этой
+            queue.submit(owner, user_topic, functools.partial(
+                run_generation_job,
+                content_generator=content_generator,
+                image_generator=image_generator,
+                topic_index=st.session_state["topic_index"],
+                stream=st.session_state["stream_generation"],
+            ))
+
+    for job in queue.collect(owner):
+        if job.batch is not None:
+            batches = st.session_state["generated_batches"]
+            batches.append(job.batch)
+            del batches[:-MAX_SESSION_BATCHES]
+            st.session_state["batch_indices"][job.batch["id"]] = 0
+        else:
+            st.error(_job_error_message(job.error))
+
+    if any(job.active for job in queue.jobs(owner)):
+        _render_job_progress(owner)
 
     if st.session_state["generated_batches"]:
         st.divider()
@@ -608,30 +491,19 @@ def main() -> None:
         for batch in reversed(st.session_state["generated_batches"]):
             container = st.container()
             with container:
-                meta_text = (
-                    f"ID: `{batch['id']}` · Создано: {batch['timestamp']} · "
-                    f"CTA: {batch.get('cta', 'не задано')}"
-                )
-                st.caption(meta_text)
-
-                if batch.get("tags"):
-                    st.caption("Теги: " + " ".join(batch["tags"]))
-
-                _render_image_viewer(batch["id"], batch["theme"], batch["images"])
-
-                zip_file = _images_to_zip(batch["images"], batch["theme"])
-                download_label = f"Скачать ZIP для темы «{batch['theme']}»"
-                st.download_button(
-                    download_label,
-                    data=zip_file,
-                    file_name=f"{_sanitize_filename(batch['theme'])}.zip",
-                    mime="application/zip",
-                    key=f"download_{batch['id']}",
-                )
-                st.write("---")
+                _render_batch(batch)
     else:
         st.info("Здесь появятся карточки после первой генерации.")
 
+    st.divider()
+    with st.expander("Архив подборок", expanded=False):
+        _render_archive()
+
+    # Панель рисуется последней, чтобы показать замеры только что завершенной генерации
+    if st.session_state["show_metrics"]:
+        with st.sidebar:
+            _render_metrics_panel()
+
 
 if __name__ == "__main__":
     main()
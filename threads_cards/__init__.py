@@ -0,0 +1,17 @@
+"""
+Ядро генератора карточек Threads без зависимости от Streamlit
+
+    prompts  — системные промпты
+    errors   — ошибки генерации
+    schema   — контракт формата поста
+    metrics  — замеры этапов
+    llm      — генерация текста моделью (openai импортируется лениво)
+    render   — верстка, отрисовка и кодирование карточек
+    topics   — учет использованных тем
+    storage  — хранилище карточек, ZIP и архив подборок
+    jobs     — очередь фоновых генераций
+
+Модули пакета импортируются один раз на процесс и остаются в sys.modules,
+поэтому перезапуски скрипта Streamlit не переопределяют классы и не
+пересоздают общие объекты (кэши, пулы, клиент OpenAI).
+"""
@@ -0,0 +1,43 @@
+"""Ошибки генерации контента"""
+
+
+class ThreadGenerationError(Exception):
+    """Базовая ошибка генерации контента"""
+
+
+class GenerationAuthError(ThreadGenerationError):
+    """Неверный или не имеющий доступа API-ключ"""
+
+
+class GenerationRateLimitError(ThreadGenerationError):
+    """Превышен лимит запросов (429), попытки исчерпаны"""
+
+
+class GenerationTimeoutError(ThreadGenerationError):
+    """Не удалось соединиться или дождаться ответа, попытки исчерпаны"""
+
+
+class GenerationAPIError(ThreadGenerationError):
+    """Ошибка API OpenAI"""
+
+    def __init__(self, message: str, status_code: int | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class InvalidModelResponseError(ThreadGenerationError):
+    """Модель вернула ответ, который не удалось разобрать как JSON"""
+
+
+class ReplayMissError(ThreadGenerationError):
+    """В режиме воспроизведения для запроса нет записанного ответа"""
+
+
+class DuplicateTopicError(ThreadGenerationError):
+    """Модель вернула тему, которая уже была (точный или почти точный повтор)"""
+
+    def __init__(self, theme: str, existing: str, similarity: float):
+        super().__init__(f"Тема «{theme}» повторяет «{existing}» (сходство {similarity:.0%})")
+        self.theme = theme
+        self.existing = existing
+        self.similarity = similarity
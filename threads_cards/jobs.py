@@ -0,0 +1,194 @@
+"""Очередь фоновых генераций"""
+
+import functools
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from PIL import Image
+
+from .errors import DuplicateTopicError
+from .llm import ThreadsCardGenerator
+from .metrics import get_stage_metrics
+from .render import ImageGenerator, StreamingCardRenderer
+from .storage import batch_content_hash, get_batch_archive, get_blob_store, store_images
+from .topics import TopicIndex, build_random_topic_request
+
+
+class GenerationJob:
+    """Одна фоновая генерация: тема, этап, прогресс и результат"""
+
+    def __init__(self, owner: str, topic: str):
+        self.id = f"job_{uuid.uuid4().hex[:8]}"
+        self.owner = owner
+        self.topic = topic
+        self.status = "queued"  # queued → running → done | failed
+        self.stage = "В очереди"
+        self.done = 0
+        self.total = 0
+        self.batch: Dict | None = None
+        # (роль, ключ blob превью) карточек, нарисованных по ходу потокового ответа
+        self.previews: List[Tuple[str, str]] = []
+        self.error: Exception | None = None
+        self.finished_at: float | None = None
+
+    def progress(self, stage: str, done: int = 0, total: int = 0) -> None:
+        """Обновляет этап; total=0 — число шагов этапа еще неизвестно"""
+        self.stage, self.done, self.total = stage, done, total
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+
+class GenerationQueue:
+    """
+    Общая на процесс очередь фоновых генераций
+
+    Задания выполняет пул потоков: ожидание модели не держит скрипт
+    Streamlit, карточки рисует общий пул процессов. Задания привязаны к
+    владельцу (идентификатор сессии в адресе страницы), поэтому результат
+    можно забрать после любого перезапуска скрипта или переподключения.
+    Готовые задания хранятся, пока их не заберут, но не дольше ttl секунд.
+    """
+
+    def __init__(self, max_workers: int = 4, ttl: float = 3600.0):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._jobs: Dict[str, GenerationJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, owner: str, topic: str, work: Callable[[GenerationJob], Dict]) -> GenerationJob:
+        """Ставит генерацию в очередь; work получает задание и возвращает подборку"""
+        job = GenerationJob(owner, topic)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, work)
+        return job
+
+    @staticmethod
+    def _run(job: GenerationJob, work: Callable[[GenerationJob], Dict]) -> None:
+        job.status = "running"
+        try:
+            job.batch = work(job)
+            job.status = "done"
+        except Exception as error:
+            job.error = error
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self) -> None:
+        deadline = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < deadline]:
+            del self._jobs[job_id]
+
+    def jobs(self, owner: str) -> List[GenerationJob]:
+        """Задания владельца в порядке постановки"""
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owner == owner]
+
+    def collect(self, owner: str) -> List[GenerationJob]:
+        """Забирает завершенные задания владельца (успешные и с ошибкой)"""
+        with self._lock:
+            finished = [job for job in self._jobs.values() if job.owner == owner and not job.active]
+            for job in finished:
+                del self._jobs[job.id]
+        return finished
+
+
+@functools.lru_cache(maxsize=None)
+def get_generation_queue() -> GenerationQueue:
+    """Общая на процесс очередь генераций (число потоков — THREADS_CARDS_GENERATION_WORKERS)"""
+    return GenerationQueue(max_workers=int(os.getenv("THREADS_CARDS_GENERATION_WORKERS", "4")))
+
+
+def run_generation_job(
+    job: GenerationJob,
+    content_generator: ThreadsCardGenerator,
+    image_generator: ImageGenerator,
+    topic_index: TopicIndex,
+    stream: bool,
+) -> Dict:
+    """Тело фонового задания: текст у модели, карточки, сохранение в архив"""
+    topic_used = job.topic
+    used_random_topic = not topic_used
+
+    def reject_repeated_theme(theme: str) -> None:
+        duplicate = topic_index.find_duplicate(theme)
+        if duplicate is not None:
+            raise DuplicateTopicError(theme, *duplicate)
+
+    def card_streamed(index: int, reply: Dict, card_img: Image.Image) -> None:
+        # Превью кодируется сразу: в finish() на этом же изображении дорисуется счетчик
+        preview = image_generator.render_preview(card_img) or card_img
+        job.previews.append((reply.get("role", ""), get_blob_store().put(image_generator.encoder.encode(preview).data)))
+        job.progress("Модель пишет реплики, карточки рисуются по ходу", index + 1)
+
+    try:
+        # Повтор случайной темы отклоняется до рисования карточек,
+        # совпавшая тема попадает в исключения следующей попытки
+        attempts = 3 if used_random_topic else 1
+        for attempt in range(attempts):
+            if used_random_topic:
+                topic_used = build_random_topic_request(topic_index.exclusions())
+            on_theme = reject_repeated_theme if used_random_topic else None
+            job.progress("Запрос к модели")
+            job.previews = []
+            try:
+                if stream:
+                    streaming_renderer = StreamingCardRenderer(image_generator, on_card=card_streamed)
+                    thread_content = content_generator.generate_thread_content(
+                        topic_used, on_reply=streaming_renderer.add_reply, on_theme=on_theme
+                    )
+                else:
+                    streaming_renderer = None
+                    thread_content = content_generator.generate_thread_content(topic_used, on_theme=on_theme)
+                break
+            except DuplicateTopicError:
+                if attempt == attempts - 1:
+                    raise
+
+        replies = thread_content.get("replies", [])
+        if not replies:
+            raise ValueError("Модель вернула пустой список реплик. Попробуйте снова.")
+
+        job.progress("Карточки", 0, len(replies))
+        if streaming_renderer is not None:
+            generated_images = store_images(streaming_renderer.finish(thread_content))
+        else:
+            generated_images = store_images(image_generator.render_thread(
+                thread_content, on_card=lambda done, total: job.progress("Карточки", done, total)
+            ))
+
+        theme = thread_content.get("theme", topic_used)
+        batch_payload = {
+            "id": f"thread_{uuid.uuid4().hex}",
+            "model_id": thread_content.get("id"),
+            "theme": theme,
+            "topic_used": topic_used,
+            "replies": replies,
+            "images": generated_images,
+            "cta": thread_content.get("cta"),
+            "tags": thread_content.get("tags", []),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "content_hash": batch_content_hash(generated_images, theme),
+            "colors": dict(image_generator.colors),
+            "image_format": image_generator.encoder.image_format,
+            "compress_level": image_generator.encoder.compress_level,
+            "extra_sizes": list(image_generator.extra_sizes),
+            "preview_width": image_generator.preview_width,
+        }
+        job.progress("Сохранение в архив", len(replies), len(replies))
+        get_batch_archive().save(batch_payload)
+
+        if used_random_topic:
+            topic_index.add(theme)
+        return batch_payload
+    finally:
+        get_stage_metrics().flush()
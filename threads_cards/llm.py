@@ -0,0 +1,730 @@
+"""
+Генерация текста постов моделью OpenAI
+
+Пакет openai тяжелый (десятки модулей pydantic и httpx), поэтому он
+импортируется только при первом обращении к API; режим воспроизведения из
+кэша ответов обходится без него.
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import time
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+
+from .errors import (
+    GenerationAPIError,
+    GenerationAuthError,
+    GenerationRateLimitError,
+    GenerationTimeoutError,
+    InvalidModelResponseError,
+    ReplayMissError,
+    ThreadGenerationError,
+)
+from .metrics import get_stage_metrics
+from .prompts import DEFAULT_SYSTEM_PROMPT, REPAIR_SYSTEM_PROMPT
+from .schema import RENDERABLE_SCHEMA, THREAD_SCHEMA, SchemaIssue
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+
+def _openai():
+    """Модуль openai; импортируется при первом запросе к API"""
+    import openai
+
+    return openai
+
+
+class LLMResponseCache:
+    """
+    Дисковый кэш ответов модели (SQLite)
+
+    Ключ — хэш (системный промпт, сообщение пользователя, модель, температура,
+    response_format). Записи старше ttl_seconds не выдаются; при превышении
+    max_bytes удаляются давно не использованные записи.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+    """
+
+    def __init__(self, path: str, ttl_seconds: float | None = 7 * 24 * 3600, max_bytes: int = 200 * 1024 * 1024):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+
+    @staticmethod
+    def key_for(request: Dict) -> str:
+        """Ключ кэша для параметров запроса chat.completions"""
+        messages = request.get("messages", [])
+        payload = {
+            "system": [m["content"] for m in messages if m["role"] == "system"],
+            "user": [m["content"] for m in messages if m["role"] == "user"],
+            "model": request.get("model"),
+            "temperature": request.get("temperature"),
+            "response_format": request.get("response_format"),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Возвращает сохраненный ответ или None (нет записи либо она устарела)"""
+        now = time.time()
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection, connection:
+            row = connection.execute("SELECT content, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            content, created = row
+            if self.ttl_seconds is not None and now - created > self.ttl_seconds:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return content
+
+    def put(self, key: str, content: str) -> None:
+        """Сохраняет ответ и при необходимости освобождает место"""
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, content, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, content, size, now, now),
+            )
+            if self.ttl_seconds is not None:
+                connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                rows = connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+                evicted = []
+                for old_key, old_size in rows:
+                    if total <= self.max_bytes or old_key == key:
+                        break
+                    evicted.append((old_key,))
+                    total -= old_size
+                connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm_cache() -> LLMResponseCache:
+    """Общий на процесс кэш ответов модели (путь задается THREADS_CARDS_LLM_CACHE_PATH)"""
+    return LLMResponseCache(os.getenv("THREADS_CARDS_LLM_CACHE_PATH", "threads_cards_llm_cache.sqlite3"))
+
+
+class RepliesStreamParser:
+    """
+    Инкрементальный разбор JSON-ответа модели
+
+    Получает текст по кускам и возвращает объекты массива replies верхнего
+    уровня, как только каждый из них закрыт. Текст просматривается один раз.
+    Строковое значение theme верхнего уровня доступно в .theme сразу после
+    его получения.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.theme = None
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_key = None
+        self._expect_key = False
+        self._replies_depth = None
+        self._replies_closed = False
+        self._object_start = None
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """Добавляет кусок ответа и возвращает реплики, завершившиеся в нем"""
+        self.text += chunk
+        text = self.text
+        replies = []
+        for idx in range(self._position, len(text)):
+            char = text[idx]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        value = json.loads(text[self._string_start:idx + 1])
+                        if self._expect_key:
+                            self._last_key = value
+                        elif self._last_key == "theme" and self.theme is None:
+                            self.theme = value
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = idx
+            elif self._depth == 1 and char in ',:':
+                # Ключ ожидается после { и запятой, значение — после двоеточия
+                self._expect_key = char == ','
+            elif char in '{[':
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = char == '{'
+                if (
+                    char == '['
+                    and self._depth == 2
+                    and self._last_key == "replies"
+                    and not self._replies_closed
+                ):
+                    self._replies_depth = self._depth
+                elif char == '{' and self._replies_depth is not None and self._depth == self._replies_depth + 1:
+                    self._object_start = idx
+            elif char in '}]':
+                if char == '}' and self._object_start is not None and self._depth == self._replies_depth + 1:
+                    try:
+                        reply = json.loads(text[self._object_start:idx + 1])
+                    except ValueError:
+                        reply = None
+                    if isinstance(reply, dict):
+                        replies.append(reply)
+                    self._object_start = None
+                elif char == ']' and self._replies_depth is not None and self._depth == self._replies_depth:
+                    self._replies_depth = None
+                    self._replies_closed = True
+                self._depth -= 1
+        self._position = len(text)
+        return replies
+
+
+# Клиенты OpenAI по (хэш ключа, таймауты, base_url): небольшой LRU, чтобы
+# смена ключей не копила клиенты с ключами и пулами соединений
+_MAX_CLIENTS = 8
+_clients: "OrderedDict[Tuple[str, float, float, str | None], OpenAI]" = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(
+    api_key: str,
+    connect_timeout: float = 10.0,
+    read_timeout: float = 90.0,
+    base_url: str | None = None,
+) -> "OpenAI":
+    """
+    Общий на процесс клиент OpenAI для ключа и таймаутов
+
+    Клиент держит пул keep-alive соединений, поэтому переиспользуется между
+    нажатиями и перезапусками скрипта. Встроенные повторы SDK отключены —
+    ими управляет ThreadsCardGenerator. base_url позволяет направить запросы
+    на совместимый локальный сервер. Хранится не больше _MAX_CLIENTS
+    клиентов, вытесненные закрываются.
+    """
+    key = (hashlib.sha256(api_key.encode("utf-8")).hexdigest(), connect_timeout, read_timeout, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+        openai = _openai()
+        client = openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=openai.Timeout(read_timeout, connect=connect_timeout),
+            max_retries=0,
+        )
+        _clients[key] = client
+        evicted = []
+        while len(_clients) > _MAX_CLIENTS:
+            evicted.append(_clients.popitem(last=False)[1])
+    for old_client in evicted:
+        old_client.close()
+    return client
+
+
+class ThreadsCardGenerator:
+    """ИИ-агент для генерации вирусных карточек Threads"""
+
+    RETRYABLE_STATUS_CODES = {408, 409, 429}
+    
+    def __init__(
+        self,
+        api_key: str,
+        system_prompt: str | None = None,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 90.0,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        response_cache: LLMResponseCache | None = None,
+        replay_only: bool = False,
+        base_url: str | None = None,
+        max_repairs: int = 1,
+    ):
+        if replay_only and response_cache is None:
+            raise ValueError("Режим воспроизведения требует кэша ответов")
+        # В режиме воспроизведения сеть не нужна, клиент не создаем
+        self.client = None if replay_only else get_openai_client(api_key, connect_timeout, read_timeout, base_url)
+        self.response_cache = response_cache
+        self.replay_only = replay_only
+        self._api_key = api_key
+        self._timeouts = (read_timeout, connect_timeout)
+        self._base_url = base_url
+        self._async_client: "AsyncOpenAI | None" = None
+        prompt = system_prompt or self._load_system_prompt()
+        self.system_prompt = prompt.strip() if isinstance(prompt, str) else DEFAULT_SYSTEM_PROMPT
+        # Контракт THREAD_SCHEMA описан в DEFAULT_SYSTEM_PROMPT; у своего промпта — только минимальный
+        self.schema = THREAD_SCHEMA if self.system_prompt == DEFAULT_SYSTEM_PROMPT.strip() else RENDERABLE_SCHEMA
+        self.model = "gpt-4o"
+        self.temperature = 0.9
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_repairs = max_repairs
+        
+    def _load_system_prompt(self) -> str:
+        """Загружает системный промпт для ИИ"""
+        return DEFAULT_SYSTEM_PROMPT
+
+    def _is_retryable(self, error: Exception) -> bool:
+        openai = _openai()
+        if isinstance(error, openai.APIConnectionError):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in self.RETRYABLE_STATUS_CODES or error.status_code >= 500
+        return False
+
+    def _backoff_delay(self, attempt: int, error: Exception) -> float:
+        """Экспоненциальная задержка с полным джиттером; Retry-After сервера имеет приоритет"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return max(delay, min(self.backoff_max, float(retry_after)))
+        except (TypeError, ValueError):
+            return delay
+
+    def _translate_error(self, error: Exception) -> ThreadGenerationError:
+        """Переводит исключение SDK в типизированную ошибку генерации"""
+        message = f"Ошибка при генерации контента: {error}"
+        openai = _openai()
+        if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+            return GenerationAuthError(message)
+        if isinstance(error, openai.RateLimitError):
+            return GenerationRateLimitError(message)
+        if isinstance(error, openai.APIConnectionError):
+            return GenerationTimeoutError(message)
+        if isinstance(error, openai.APIStatusError):
+            return GenerationAPIError(message, error.status_code)
+        return ThreadGenerationError(message)
+
+    def _create_completion(self, **request):
+        """Вызывает chat.completions.create с повторами на 408/409/429/5xx и сетевых ошибках"""
+        metrics = get_stage_metrics()
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer("llm_request"):
+                    response = self.client.chat.completions.create(**request)
+                if not request.get("stream"):
+                    metrics.record_usage(response.usage)
+                return response
+            except Exception as error:
+                if attempt >= self.max_retries or not self._is_retryable(error):
+                    raise self._translate_error(error) from error
+                delay = self._backoff_delay(attempt, error)
+                self._on_retry(error, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _on_retry(self, error: Exception, delay: float) -> None:
+        """Вызывается после неудачной попытки перед паузой delay (точка расширения для подклассов)"""
+
+    async def _before_attempt(self) -> None:
+        """Вызывается перед каждой асинхронной попыткой запроса (точка расширения для подклассов)"""
+
+    @property
+    def async_client(self) -> "AsyncOpenAI":
+        """Асинхронный клиент; создается при первом обращении внутри работающего цикла событий"""
+        if self._async_client is None:
+            openai = _openai()
+            read_timeout, connect_timeout = self._timeouts
+            self._async_client = openai.AsyncOpenAI(
+                api_key=self._api_key,
+                base_url=self._base_url,
+                timeout=openai.Timeout(read_timeout, connect=connect_timeout),
+                max_retries=0,
+            )
+        return self._async_client
+
+    async def _acreate_completion(self, **request):
+        """Асинхронный вариант _create_completion с теми же правилами повторов"""
+        metrics = get_stage_metrics()
+        attempt = 0
+        while True:
+            await self._before_attempt()
+            try:
+                with metrics.timer("llm_request"):
+                    response = await self.async_client.chat.completions.create(**request)
+                metrics.record_usage(response.usage)
+                return response
+            except Exception as error:
+                if attempt >= self.max_retries or not self._is_retryable(error):
+                    raise self._translate_error(error) from error
+                delay = self._backoff_delay(attempt, error)
+                self._on_retry(error, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _stream_completion(
+        self,
+        request: Dict,
+        on_reply: Callable[[Dict], None],
+        on_theme: Callable[[str], None] | None = None,
+    ) -> str:
+        """
+        Читает потоковый ответ, передавая в on_reply каждую завершенную реплику
+
+        on_theme вызывается один раз, как только получена тема. Исключения
+        из on_reply и on_theme прерывают поток и выходят наружу без изменений;
+        соединение закрывается в любом случае.
+        """
+        parser = RepliesStreamParser()
+        metrics = get_stage_metrics()
+        started = time.perf_counter()
+        stream = self._create_completion(**request, stream=True, stream_options={"include_usage": True})
+        theme_reported = on_theme is None
+        try:
+            while True:
+                # Как ошибки API переводятся только сбои чтения потока, не колбэков
+                try:
+                    chunk = next(stream)
+                except StopIteration:
+                    break
+                except Exception as error:
+                    raise self._translate_error(error) from error
+                if getattr(chunk, "usage", None) is not None:
+                    metrics.record_usage(chunk.usage)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                replies = parser.feed(chunk.choices[0].delta.content)
+                if not theme_reported and parser.theme is not None:
+                    theme_reported = True
+                    on_theme(parser.theme)
+                for reply in replies:
+                    on_reply(reply)
+        finally:
+            stream.close()
+        metrics.record("llm_stream", time.perf_counter() - started)
+        return parser.text
+
+    def generate_thread_content(
+        self,
+        topic: str = None,
+        on_reply: Callable[[Dict], None] | None = None,
+        on_theme: Callable[[str], None] | None = None,
+    ) -> Dict:
+        """
+        Генерирует контент для карточек через OpenAI API
+        
+        Args:
+            topic: Опциональная тема для генерации
+            on_reply: если задан, ответ читается потоком и функция вызывается
+                для каждой реплики сразу после ее получения
+            on_theme: вызывается с темой ответа до первой реплики; может
+                отклонить тему, выбросив ThreadGenerationError
+            
+        Returns:
+            Dict с темой и репликами
+
+        Raises:
+            ThreadGenerationError: (или подкласс) при ошибке API или разборе ответа
+        """
+        with get_stage_metrics().timer("generate_thread"):
+            request = self.build_request(topic)
+            cache_key, raw_content = self._cached_response(request)
+
+            if raw_content is not None:
+                content = self.repair_content(self.finish_content(raw_content))
+                if on_theme is not None:
+                    on_theme(content.get("theme", ""))
+                if on_reply is not None:
+                    for reply in RepliesStreamParser().feed(raw_content):
+                        on_reply(reply)
+                return content
+
+            if on_reply is not None:
+                raw_content = self._stream_completion(request, on_reply, on_theme)
+                content = self.repair_content(self.finish_content(raw_content))
+                self._cache_responses([(cache_key, raw_content)])
+                return content
+
+            raw_content = self._create_completion(**request).choices[0].message.content
+            content = self.repair_content(self.finish_content(raw_content))
+            self._cache_responses([(cache_key, raw_content)])
+            if on_theme is not None:
+                on_theme(content.get("theme", ""))
+            return content
+
+    def generate_posts(self, topics: List[str | None], max_rounds: int = 3) -> List[Dict | None]:
+        """
+        Генерирует несколько постов одним запросом (системный промпт отправляется один раз)
+
+        Каждый пост проверяется отдельно; повторно запрашиваются только
+        слоты с ошибками, не больше max_rounds раз.
+
+        Args:
+            topics: темы слотов (None — любая тема)
+
+        Returns:
+            Посты в порядке тем; None для слота, который так и не удался
+        """
+        posts: List[Dict | None] = [None] * len(topics)
+        pending = list(range(len(topics)))
+        for _ in range(max_rounds):
+            if not pending:
+                break
+            request = self._build_posts_request([topics[idx] for idx in pending])
+            cache_key, raw_content = self._cached_response(request)
+            if raw_content is None:
+                raw_content = self._create_completion(**request).choices[0].message.content
+            else:
+                cache_key = None
+            pending = self._collect_posts(raw_content, pending, posts, cache_key)
+        return posts
+
+    async def agenerate_posts(self, topics: List[str | None], max_rounds: int = 3) -> List[Dict | None]:
+        """Асинхронный вариант generate_posts"""
+        posts: List[Dict | None] = [None] * len(topics)
+        pending = list(range(len(topics)))
+        for _ in range(max_rounds):
+            if not pending:
+                break
+            request = self._build_posts_request([topics[idx] for idx in pending])
+            cache_key, raw_content = self._cached_response(request)
+            if raw_content is None:
+                response = await self._acreate_completion(**request)
+                raw_content = response.choices[0].message.content
+            else:
+                cache_key = None
+            pending = self._collect_posts(raw_content, pending, posts, cache_key)
+        return posts
+
+    def _build_posts_request(self, topics: List[str | None]) -> Dict:
+        """Запрос на несколько постов: ответ — объект {"posts": [...]} с полем slot в каждом посте"""
+        slots = "\n".join(
+            f"{slot}. {topic or 'Любая тема, которая точно удивит'}"
+            for slot, topic in enumerate(topics, start=1)
+        )
+        user_message = (
+            f"Сгенерируй {len(topics)} разных новых вирусных постов, по одному на каждую тему из списка:\n"
+            f"{slots}\n"
+            'Верни JSON-объект {"posts": [...]}, где каждый элемент — пост в описанном формате '
+            'с дополнительным полем "slot" — номером темы из списка.'
+        )
+        return self.build_request(None, user_message=user_message)
+
+    def _collect_posts(
+        self,
+        raw_content: str | None,
+        pending: List[int],
+        posts: List[Dict | None],
+        cache_key: str | None,
+    ) -> List[int]:
+        """Раскладывает посты ответа по слотам; возвращает слоты, которые нужно запросить снова"""
+        try:
+            candidates = json.loads(raw_content).get("posts")
+        except (TypeError, ValueError, AttributeError):
+            return pending
+        if not isinstance(candidates, list):
+            return pending
+
+        by_slot: Dict[int, Dict] = {}
+        for position, candidate in enumerate(candidates, start=1):
+            if not isinstance(candidate, dict):
+                continue
+            slot = candidate.pop("slot", position)
+            if isinstance(slot, int) and 1 <= slot <= len(pending) and slot not in by_slot:
+                by_slot[slot] = candidate
+
+        failed = []
+        for slot, idx in enumerate(pending, start=1):
+            candidate = by_slot.get(slot)
+            if candidate is None or self.schema.repair_locally(candidate):
+                failed.append(idx)
+                continue
+            if "id" not in candidate:
+                candidate["id"] = f"post_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+            posts[idx] = candidate
+
+        # Кэшируем только ответы, из которых удалось взять хотя бы один пост
+        if cache_key and len(failed) < len(pending):
+            self.response_cache.put(cache_key, raw_content)
+        return failed
+
+    async def agenerate_thread_content(self, topic: str = None) -> Dict:
+        """Асинхронный вариант generate_thread_content (для массовой генерации)"""
+        with get_stage_metrics().timer("generate_thread"):
+            request = self.build_request(topic)
+            cache_key, raw_content = self._cached_response(request)
+            if raw_content is not None:
+                return await self.arepair_content(self.finish_content(raw_content))
+            response = await self._acreate_completion(**request)
+            raw_content = response.choices[0].message.content
+            content = await self.arepair_content(self.finish_content(raw_content))
+            self._cache_responses([(cache_key, raw_content)])
+            return content
+
+    def repair_content(self, content: Dict) -> Dict:
+        """
+        Приводит пост к контракту self.schema: сначала локальные исправления,
+        затем (не больше max_repairs раз и только для стандартного промпта)
+        короткий запрос к модели с полями, которые нельзя исправить на месте
+
+        Raises:
+            InvalidModelResponseError: если нарушения остались
+        """
+        issues = self.schema.repair_locally(content)
+        responses = []
+        for _ in range(self.max_repairs if self.schema.repairable else 0):
+            if not issues:
+                break
+            request, fields = self._build_repair_request(content, issues)
+            cache_key, raw_content = self._cached_response(request)
+            if raw_content is None:
+                raw_content = self._create_completion(**request).choices[0].message.content
+                responses.append((cache_key, raw_content))
+            issues = self._apply_repair(content, raw_content, fields)
+        content = self._checked_content(content, issues)
+        self._cache_responses(responses)
+        return content
+
+    async def arepair_content(self, content: Dict) -> Dict:
+        """Асинхронный вариант repair_content"""
+        issues = self.schema.repair_locally(content)
+        responses = []
+        for _ in range(self.max_repairs if self.schema.repairable else 0):
+            if not issues:
+                break
+            request, fields = self._build_repair_request(content, issues)
+            cache_key, raw_content = self._cached_response(request)
+            if raw_content is None:
+                response = await self._acreate_completion(**request)
+                raw_content = response.choices[0].message.content
+                responses.append((cache_key, raw_content))
+            issues = self._apply_repair(content, raw_content, fields)
+        content = self._checked_content(content, issues)
+        self._cache_responses(responses)
+        return content
+
+    def _build_repair_request(self, content: Dict, issues: List[SchemaIssue]) -> Tuple[Dict, List[str]]:
+        """Небольшой запрос на исправление: короткий системный промпт, пост и список нарушений"""
+        whole_replies = any(issue.field == "replies" for issue in issues)
+        fields = sorted({
+            "replies" if whole_replies and issue.field.startswith("replies") else issue.field
+            for issue in issues
+        })
+        post = {key: value for key, value in content.items() if key != "id"}
+        problems = "\n".join(f"- {issue.message}" for issue in issues)
+        user_message = (
+            f"Пост:\n{json.dumps(post, ensure_ascii=False)}\n\n"
+            f"Нарушения:\n{problems}\n\n"
+            f"Верни JSON-объект с ключами: {', '.join(fields)}"
+        )
+        request = dict(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": REPAIR_SYSTEM_PROMPT},
+                {"role": "user", "content": user_message},
+            ],
+            temperature=self.temperature,
+            response_format={"type": "json_object"},
+        )
+        return request, fields
+
+    def _apply_repair(self, content: Dict, raw_content: str | None, fields: List[str]) -> List[SchemaIssue]:
+        """Переносит исправленные поля в пост; возвращает оставшиеся нарушения"""
+        try:
+            patch = json.loads(raw_content)
+        except (TypeError, ValueError):
+            patch = None
+        if isinstance(patch, dict):
+            for field in fields:
+                value = patch.get(field)
+                if field == "theme" and isinstance(value, str):
+                    content["theme"] = value
+                elif field == "replies" and isinstance(value, list):
+                    content["replies"] = value
+                elif field.startswith("replies[") and isinstance(value, dict):
+                    idx = int(field[len("replies["):-1]) - 1
+                    if idx < len(content.get("replies", [])):
+                        content["replies"][idx] = value
+        return self.schema.repair_locally(content)
+
+    @staticmethod
+    def _checked_content(content: Dict, issues: List[SchemaIssue]) -> Dict:
+        if issues:
+            details = "; ".join(issue.message for issue in issues)
+            raise InvalidModelResponseError(f"Ошибка при генерации контента: ответ не соответствует формату ({details})")
+        return content
+
+    def build_request(self, topic: str | None, user_message: str | None = None) -> Dict:
+        """Параметры запроса chat.completions для темы (или для готового сообщения пользователя)"""
+        if user_message is None:
+            user_message = "Сгенерируй новый вирусный пост в формате JSON."
+            if topic:
+                user_message += f" {topic}"
+            
+        return dict(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=self.temperature,
+            response_format={"type": "json_object"}
+        )
+
+    def _cached_response(self, request: Dict) -> Tuple[str | None, str | None]:
+        """Возвращает (ключ кэша, записанный ответ); в режиме воспроизведения промах — ошибка"""
+        if self.response_cache is None:
+            return None, None
+        cache_key = LLMResponseCache.key_for(request)
+        raw_content = self.response_cache.get(cache_key)
+        if raw_content is None and self.replay_only:
+            raise ReplayMissError("Ошибка при генерации контента: нет записанного ответа для этого запроса")
+        return cache_key, raw_content
+
+    def _cache_responses(self, responses: List[Tuple[str | None, str]]) -> None:
+        """Записывает ответы модели в кэш; вызывается только после успешной проверки поста"""
+        for cache_key, raw_content in responses:
+            if cache_key:
+                self.response_cache.put(cache_key, raw_content)
+
+    def finish_content(self, raw_content: str | None) -> Dict:
+        """Разбирает ответ модели и добавляет ID (в кэш ответ пишется только после проверки)"""
+        try:
+            content = json.loads(raw_content)
+        except (TypeError, ValueError) as error:
+            raise InvalidModelResponseError(f"Ошибка при генерации контента: некорректный JSON ({error})") from error
+        if not isinstance(content, dict):
+            raise InvalidModelResponseError("Ошибка при генерации контента: ответ должен быть JSON-объектом")
+        
+        # Добавляем ID если отсутствует
+        if "id" not in content:
+            content["id"] = f"post_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+        return content
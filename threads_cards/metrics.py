@@ -0,0 +1,187 @@
+"""Замеры этапов генерации и рендеринга"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class StageMetrics:
+    """
+    Время и ресурсы этапов генерации
+
+    Для каждого этапа (llm_request, markdown, layout, raster, encode, zip …)
+    копятся гистограмма длительности, суммарное процессорное время потока и
+    последние значения для перцентилей; для запросов к модели — токены из
+    usage. Замер стоит пару вызовов perf_counter, поэтому включен всегда.
+    События ждут flush(): он дописывает их в metrics.jsonl и
+    перезаписывает metrics.prom (текстовый формат Prometheus) в out_dir.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, out_dir: str | None = None, recent_samples: int = 1000):
+        self.out_dir = out_dir
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, List[int]] = {}
+        self._counts: Dict[str, int] = {}
+        self._sums: Dict[str, float] = {}
+        self._cpu: Dict[str, float] = {}
+        self._recent: Dict[str, deque] = {}
+        self._recent_samples = recent_samples
+        self._tokens = {"prompt": 0, "completion": 0, "total": 0}
+        # Без out_dir события никто не забирает — храним только последние
+        self._pending: deque = deque(maxlen=10000)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Замеряет блок: with metrics.timer("layout"): ..."""
+        started, cpu_started = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, time.thread_time() - cpu_started)
+
+    def record(self, stage: str, seconds: float, cpu_seconds: float = 0.0) -> None:
+        with self._lock:
+            self._observe(stage, seconds, cpu_seconds)
+            self._pending.append({"ts": time.time(), "stage": stage, "seconds": seconds, "cpu_seconds": cpu_seconds})
+
+    def _observe(self, stage: str, seconds: float, cpu_seconds: float) -> None:
+        if stage not in self._histograms:
+            self._histograms[stage] = [0] * len(self.BUCKETS)
+            self._counts[stage] = 0
+            self._sums[stage] = 0.0
+            self._cpu[stage] = 0.0
+            self._recent[stage] = deque(maxlen=self._recent_samples)
+        counts = self._histograms[stage]
+        for idx, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                counts[idx] += 1
+        self._counts[stage] += 1
+        self._sums[stage] += seconds
+        self._cpu[stage] += cpu_seconds
+        self._recent[stage].append(seconds)
+
+    def record_usage(self, usage) -> None:
+        """Учитывает токены из usage ответа OpenAI (объект SDK или None)"""
+        if usage is None:
+            return
+        tokens = {
+            "prompt": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion": getattr(usage, "completion_tokens", 0) or 0,
+            "total": getattr(usage, "total_tokens", 0) or 0,
+        }
+        with self._lock:
+            for kind, value in tokens.items():
+                self._tokens[kind] += value
+            self._pending.append({"ts": time.time(), "stage": "llm_usage", **{f"{k}_tokens": v for k, v in tokens.items()}})
+
+    def take_events(self) -> List[Dict]:
+        """Забирает накопленные события (рабочий процесс пула возвращает их вместе с карточкой)"""
+        with self._lock:
+            events = list(self._pending)
+            self._pending.clear()
+        return events
+
+    def merge(self, events: List[Dict]) -> None:
+        """Учитывает события, замеренные в другом процессе"""
+        with self._lock:
+            for event in events:
+                if "seconds" in event:
+                    self._observe(event["stage"], event["seconds"], event.get("cpu_seconds", 0.0))
+                self._pending.append(event)
+
+    @staticmethod
+    def peak_rss_bytes() -> int | None:
+        """Пиковый объем памяти процесса (ru_maxrss в Linux — в килобайтах)"""
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def summary(self) -> List[Dict]:
+        """Сводка по этапам для панели: число замеров, среднее, p50, p95 (мс)"""
+        rows = []
+        with self._lock:
+            for stage, recent in sorted(self._recent.items()):
+                count = self._counts[stage]
+                ordered = sorted(recent)
+                rows.append({
+                    "этап": stage,
+                    "замеров": count,
+                    "среднее, мс": round(self._sums[stage] / count * 1000, 2),
+                    "p50, мс": round(ordered[len(ordered) // 2] * 1000, 2),
+                    "p95, мс": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+                    "CPU, с": round(self._cpu[stage], 3),
+                })
+        return rows
+
+    @property
+    def tokens(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._tokens)
+
+    def prometheus_text(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = [
+            "# HELP threads_cards_stage_seconds Длительность этапов генерации",
+            "# TYPE threads_cards_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, counts in sorted(self._histograms.items()):
+                total = self._counts[stage]
+                for bound, count in zip(self.BUCKETS, counts):
+                    lines.append(f'threads_cards_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'threads_cards_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {total}')
+                lines.append(f'threads_cards_stage_seconds_sum{{stage="{stage}"}} {self._sums[stage]:.6f}')
+                lines.append(f'threads_cards_stage_seconds_count{{stage="{stage}"}} {total}')
+            lines += [
+                "# HELP threads_cards_stage_cpu_seconds_total Процессорное время этапов",
+                "# TYPE threads_cards_stage_cpu_seconds_total counter",
+            ]
+            lines += [
+                f'threads_cards_stage_cpu_seconds_total{{stage="{stage}"}} {cpu:.6f}'
+                for stage, cpu in sorted(self._cpu.items())
+            ]
+            lines += [
+                "# HELP threads_cards_llm_tokens_total Токены запросов к модели",
+                "# TYPE threads_cards_llm_tokens_total counter",
+            ]
+            lines += [f'threads_cards_llm_tokens_total{{kind="{kind}"}} {value}' for kind, value in self._tokens.items()]
+        rss = self.peak_rss_bytes()
+        if rss is not None:
+            lines += [
+                "# HELP threads_cards_process_peak_rss_bytes Пиковый объем памяти процесса",
+                "# TYPE threads_cards_process_peak_rss_bytes gauge",
+                f"threads_cards_process_peak_rss_bytes {rss}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def flush(self) -> None:
+        """Дописывает события в metrics.jsonl и обновляет metrics.prom (если задан out_dir)"""
+        if not self.out_dir:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        events = self.take_events()
+        if events:
+            with open(os.path.join(self.out_dir, "metrics.jsonl"), "a", encoding="utf-8") as jsonl_file:
+                jsonl_file.writelines(json.dumps(event, ensure_ascii=False) + "\n" for event in events)
+        prom_path = os.path.join(self.out_dir, "metrics.prom")
+        with open(f"{prom_path}.tmp", "w", encoding="utf-8") as prom_file:
+            prom_file.write(self.prometheus_text())
+        os.replace(f"{prom_path}.tmp", prom_path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_stage_metrics() -> StageMetrics:
+    """Общий на процесс сборщик метрик (каталог файлов задается THREADS_CARDS_METRICS_DIR)"""
+    return StageMetrics(os.getenv("THREADS_CARDS_METRICS_DIR") or None)
@@ -0,0 +1,1122 @@
+"""Верстка, отрисовка и кодирование карточек"""
+
+import functools
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from .metrics import get_stage_metrics
+
+# Шрифты лежат в пакете; THREADS_CARDS_FONT_DIR подменяет каталог целиком
+FONT_DIR = os.getenv("THREADS_CARDS_FONT_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+FONT_FILES = {
+    False: os.path.join(FONT_DIR, "DejaVuSans.ttf"),
+    True: os.path.join(FONT_DIR, "DejaVuSans-Bold.ttf"),
+}
+
+
+class TextMetricsCache:
+    """
+    Общий кэш шрифтов и метрик текста
+
+    Шрифты загружаются один раз на пару (начертание, размер), а габариты
+    слов, пробелов и строк запоминаются. Оба кэша ограничены и вытесняют
+    давно не использованные записи (LRU).
+    """
+
+    def __init__(self, max_fonts: int = 64, max_metrics: int = 50_000):
+        self.max_fonts = max_fonts
+        self.max_metrics = max_metrics
+        self._fonts: "OrderedDict[Tuple[bool, int], ImageFont.FreeTypeFont]" = OrderedDict()
+        self._bboxes: "OrderedDict[Tuple[str, int, bool], Tuple[int, int, int, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, size: int, bold: bool = False):
+        """Возвращает шрифт DejaVu Sans нужного размера, загружая файл только при первом обращении"""
+        key = (bold, size)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                return font
+
+        try:
+            font = ImageFont.truetype(FONT_FILES[bold], size)
+        except OSError:
+            font = ImageFont.load_default()
+
+        with self._lock:
+            self._fonts[key] = font
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return font
+
+    def text_bbox(self, text: str, size: int, bold: bool = False) -> Tuple[int, int, int, int]:
+        """Возвращает габариты текста (как ImageDraw.textbbox в точке (0, 0))"""
+        key = (text, size, bold)
+        with self._lock:
+            bbox = self._bboxes.get(key)
+            if bbox is not None:
+                self._bboxes.move_to_end(key)
+                self.hits += 1
+                return bbox
+
+        bbox = tuple(self.font(size, bold).getbbox(text))
+
+        with self._lock:
+            self.misses += 1
+            self._bboxes[key] = bbox
+            while len(self._bboxes) > self.max_metrics:
+                self._bboxes.popitem(last=False)
+        return bbox
+
+    def text_width(self, text: str, size: int, bold: bool = False) -> int:
+        """Ширина слова или строки"""
+        bbox = self.text_bbox(text, size, bold)
+        return bbox[2] - bbox[0]
+
+    def space_width(self, size: int, bold: bool = False) -> int:
+        """Ширина пробела"""
+        return self.text_width(' ', size, bold)
+
+    def line_height(self, size: int, bold: bool = False) -> int:
+        """Высота строки по эталонному тексту 'Ay'"""
+        bbox = self.text_bbox('Ay', size, bold)
+        return bbox[3] - bbox[1]
+
+    def clear(self) -> None:
+        """Сбрасывает кэш шрифтов и метрик"""
+        with self._lock:
+            self._fonts.clear()
+            self._bboxes.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+@functools.lru_cache(maxsize=None)
+def get_text_metrics() -> TextMetricsCache:
+    """Общий на процесс кэш метрик: переживает перезапуски скрипта Streamlit"""
+    return TextMetricsCache()
+
+
+class LayoutRun(NamedTuple):
+    """Слово с координатой x относительно начала строки"""
+    text: str
+    style: str
+    x: int
+    width: int
+
+
+class LayoutLine(NamedTuple):
+    """Строка текста: позиционированные слова, фактическая ширина и смещение по y"""
+    runs: List[LayoutRun]
+    width: int
+    y: int
+
+
+class TextLayout(NamedTuple):
+    """Результат верстки блока текста"""
+    lines: List[LayoutLine]
+    font_size: int
+    line_height: int
+    height: int
+
+
+class TextFit(NamedTuple):
+    """Подобранный размер шрифта для текстовой области карточки"""
+    layout: TextLayout
+    font_size: int
+    overflow: bool
+
+
+class TextLayoutEngine:
+    """
+    Движок переноса строк
+
+    Ширина каждого слова измеряется один раз (через TextMetricsCache) и
+    складывается инкрементально, поэтому верстка абзаца линейна по числу слов.
+    Ширина считается тем же шрифтом и с теми же пробелами, что и при отрисовке.
+
+    Режимы:
+        greedy  — жадный перенос с правилом «короткое слово держится со следующим»
+        optimal — перенос Кнута–Пласса (минимум суммы квадратов незаполненности строк)
+    """
+
+    PUNCTUATION = '.,!?;:—-'
+    GLUED_PUNCTUATION = {'.', ',', '!', ':', ';'}
+    MODES = ("greedy", "optimal")
+
+    def __init__(
+        self,
+        metrics: TextMetricsCache,
+        keep_with_next: Callable[[str], bool] | None = None,
+        mode: str = "greedy",
+        max_cached_layouts: int = 256,
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f"Неизвестный режим верстки: {mode}")
+        self.metrics = metrics
+        self.keep_with_next = keep_with_next or (lambda word: False)
+        self.mode = mode
+        self.max_cached_layouts = max_cached_layouts
+        self._layouts: "OrderedDict[tuple, TextLayout]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _joins_without_space(self, prev_style: str, text: str) -> bool:
+        """Знак препинания после жирного/курсивного фрагмента ставится вплотную"""
+        return prev_style in ('bold', 'italic') and text in self.GLUED_PUNCTUATION
+
+    def _measure(self, tokens: List[tuple], font_size: int) -> List[List[tuple]]:
+        """Разбивает токены на абзацы и считает ширину слова и отступа перед ним"""
+        paragraphs = []
+        items = []
+        for text, style in tokens:
+            if style == 'newline':
+                if items:
+                    paragraphs.append(items)
+                    items = []
+                continue
+            width = self.metrics.text_width(text, font_size, bold=(style == 'bold'))
+            if items:
+                prev_style = items[-1][1]
+                glued = self._joins_without_space(prev_style, text)
+                gap = 0 if glued else self.metrics.space_width(font_size, bold=(prev_style == 'bold'))
+            else:
+                glued, gap = False, 0
+            items.append((text, style, width, gap, glued))
+        if items:
+            paragraphs.append(items)
+        return paragraphs
+
+    def _keeps(self, item: tuple) -> bool:
+        return self.keep_with_next(item[0].rstrip(self.PUNCTUATION))
+
+    def _break_greedy(self, items: List[tuple], max_width: int) -> List[Tuple[int, int]]:
+        """Жадный перенос: возвращает границы строк [start, end)"""
+        breaks = []
+        start = 0
+        line_width = items[0][2]
+        for idx in range(1, len(items)):
+            _, _, width, gap, glued = items[idx]
+            if glued or line_width + gap + width <= max_width:
+                line_width += gap + width
+                continue
+            # Короткое слово в конце строки переносим вместе со следующим
+            if idx - start > 1 and self._keeps(items[idx - 1]):
+                breaks.append((start, idx - 1))
+                start = idx - 1
+                line_width = items[idx - 1][2] + gap + width
+            else:
+                breaks.append((start, idx))
+                start = idx
+                line_width = width
+        breaks.append((start, len(items)))
+        return breaks
+
+    def _break_optimal(self, items: List[tuple], max_width: int) -> List[Tuple[int, int]]:
+        """Перенос Кнута–Пласса; при отсутствии допустимого разбиения — жадный"""
+        count = len(items)
+        prefix = [0] * (count + 1)
+        for idx, (_, _, width, gap, _) in enumerate(items):
+            prefix[idx + 1] = prefix[idx] + gap + width
+
+        infinity = float('inf')
+        keep_penalty = max_width ** 2
+        best = [infinity] * (count + 1)
+        previous = [0] * (count + 1)
+        best[0] = 0
+
+        for end in range(1, count + 1):
+            # Нельзя переносить перед приклеенным знаком препинания
+            if end < count and items[end][4]:
+                continue
+            for start in range(end - 1, -1, -1):
+                line_width = prefix[end] - prefix[start] - items[start][3]
+                if line_width > max_width and end - start > 1:
+                    break
+                if items[start][4] or best[start] == infinity:
+                    continue
+                if end == count:
+                    cost = 0
+                else:
+                    cost = max(0, max_width - line_width) ** 2
+                    if end - start > 1 and self._keeps(items[end - 1]):
+                        cost += keep_penalty
+                if best[start] + cost < best[end]:
+                    best[end] = best[start] + cost
+                    previous[end] = start
+
+        if best[count] == infinity:
+            return self._break_greedy(items, max_width)
+
+        breaks = []
+        end = count
+        while end > 0:
+            start = previous[end]
+            breaks.append((start, end))
+            end = start
+        breaks.reverse()
+        return breaks
+
+    def layout(
+        self,
+        tokens: List[tuple],
+        font_size: int,
+        max_width: int,
+        line_spacing: int = 20,
+    ) -> TextLayout:
+        """
+        Верстает токены (слово, стиль) в строки заданной ширины
+
+        Токен со стилем 'newline' завершает абзац. Результаты кэшируются,
+        поэтому повторная верстка того же текста с теми же параметрами бесплатна.
+        """
+        key = (tuple(tokens), font_size, max_width, line_spacing)
+        with self._lock:
+            cached = self._layouts.get(key)
+            if cached is not None:
+                self._layouts.move_to_end(key)
+                return cached
+
+        line_height = self.metrics.line_height(font_size)
+        step = line_height + line_spacing
+        lines = []
+        break_lines = self._break_optimal if self.mode == "optimal" else self._break_greedy
+
+        for items in self._measure(tokens, font_size):
+            for start, end in break_lines(items, max_width):
+                runs = []
+                x = 0
+                for offset, (text, style, width, gap, _) in enumerate(items[start:end]):
+                    if offset:
+                        x += gap
+                    runs.append(LayoutRun(text, style, x, width))
+                    x += width
+                lines.append(LayoutLine(runs, x, len(lines) * step))
+
+        height = len(lines) * step - line_spacing if lines else 0
+        result = TextLayout(lines, font_size, line_height, height)
+
+        with self._lock:
+            self._layouts[key] = result
+            while len(self._layouts) > self.max_cached_layouts:
+                self._layouts.popitem(last=False)
+        return result
+
+    def fit(
+        self,
+        tokens: List[tuple],
+        max_width: int,
+        max_height: int,
+        min_font_size: int,
+        max_font_size: int,
+        line_spacing: Callable[[int], int] = lambda size: 20,
+    ) -> TextFit:
+        """
+        Бинарным поиском подбирает наибольший размер шрифта, при котором текст
+        помещается в область max_width × max_height
+
+        Если не помещается даже min_font_size, возвращает его с overflow=True.
+        """
+        def attempt(size: int) -> Tuple[TextLayout, bool]:
+            layout = self.layout(tokens, size, max_width, line_spacing(size))
+            fits = layout.height <= max_height and all(line.width <= max_width for line in layout.lines)
+            return layout, fits
+
+        layout, fits = attempt(max_font_size)
+        if fits:
+            return TextFit(layout, max_font_size, False)
+
+        best = None
+        low, high = min_font_size, max_font_size - 1
+        while low <= high:
+            middle = (low + high) // 2
+            layout, fits = attempt(middle)
+            if fits:
+                best = TextFit(layout, middle, False)
+                low = middle + 1
+            else:
+                high = middle - 1
+
+        if best is not None:
+            return best
+        layout, _ = attempt(min_font_size)
+        return TextFit(layout, min_font_size, True)
+
+
+def _is_color(background) -> bool:
+    """Строка фона, которую понимает Pillow ("#rgb", "red", "rgb(...)"), — цвет, а не путь к файлу"""
+    if not isinstance(background, str):
+        return False
+    try:
+        ImageColor.getrgb(background)
+    except ValueError:
+        return False
+    return True
+
+
+class CardTemplateCache:
+    """
+    Кэш заготовок карточек
+
+    Заготовка — фон (цвет, градиент или картинка с диска) с уже нарисованным
+    разделителем. Она строится один раз на (размер, палитра, фон, разделитель),
+    а каждая карточка получается дешевой копией. Декодированные фоновые
+    картинки тоже кэшируются и перечитываются только при изменении файла.
+    """
+
+    def __init__(self, max_templates: int = 32, max_backgrounds: int = 8):
+        self.max_templates = max_templates
+        self.max_backgrounds = max_backgrounds
+        self._templates: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._backgrounds: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _remember(cache: OrderedDict, key: tuple, value: Image.Image, limit: int) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+    def _load_background(self, path: str, size: Tuple[int, int]) -> Image.Image:
+        """Читает фон с диска и обрезает под размер карточки (с кэшем по времени изменения файла)"""
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns, size)
+        with self._lock:
+            background = self._backgrounds.get(key)
+            if background is not None:
+                self._backgrounds.move_to_end(key)
+                return background
+
+        with Image.open(path) as source:
+            source = source.convert('RGB')
+            scale = max(size[0] / source.width, size[1] / source.height)
+            resized = source.resize(
+                (max(size[0], round(source.width * scale)), max(size[1], round(source.height * scale))),
+                Image.Resampling.LANCZOS,
+            )
+        left = (resized.width - size[0]) // 2
+        top = (resized.height - size[1]) // 2
+        background = resized.crop((left, top, left + size[0], top + size[1]))
+
+        with self._lock:
+            self._remember(self._backgrounds, key, background, self.max_backgrounds)
+        return background
+
+    @staticmethod
+    def _gradient(size: Tuple[int, int], top_color: str, bottom_color: str) -> Image.Image:
+        """Вертикальный градиент между двумя цветами"""
+        mask = Image.linear_gradient('L').resize(size)
+        top = Image.new('RGB', size, top_color)
+        bottom = Image.new('RGB', size, bottom_color)
+        return Image.composite(bottom, top, mask)
+
+    def _render(self, size: Tuple[int, int], colors: Dict[str, str], background, divider: tuple) -> Image.Image:
+        if isinstance(background, (tuple, list)):
+            img = self._gradient(size, *background)
+        elif _is_color(background):
+            img = Image.new('RGB', size, background)
+        elif background:
+            img = self._load_background(background, size).copy()
+        else:
+            img = Image.new('RGB', size, colors['background'])
+
+        draw = ImageDraw.Draw(img)
+        start, end, width = divider
+        draw.line([start, end], fill=colors['accent'], width=width)
+        return img
+
+    def get(
+        self,
+        size: Tuple[int, int],
+        colors: Dict[str, str],
+        divider: tuple,
+        background: str | Tuple[str, str] | None = None,
+    ) -> Image.Image:
+        """
+        Возвращает новую карточку-заготовку (копию закэшированного шаблона)
+
+        Args:
+            size: размер карточки (ширина, высота)
+            colors: палитра ImageGenerator
+            divider: ((x0, y), (x1, y), толщина) разделителя под ролью
+            background: None — сплошной цвет палитры, "#rrggbb" — заданный цвет,
+                путь к файлу — картинка, пара цветов — вертикальный градиент
+        """
+        if isinstance(background, list):
+            background = tuple(background)
+        background_key = background
+        if isinstance(background, str) and not _is_color(background):
+            background_key = (os.path.abspath(background), os.stat(background).st_mtime_ns)
+        key = (size, tuple(sorted(colors.items())), background_key, divider)
+
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+
+        if template is None:
+            template = self._render(size, colors, background, divider)
+            with self._lock:
+                self._remember(self._templates, key, template, self.max_templates)
+
+        return template.copy()
+
+    def clear(self) -> None:
+        """Сбрасывает кэш заготовок и фонов"""
+        with self._lock:
+            self._templates.clear()
+            self._backgrounds.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_card_templates() -> CardTemplateCache:
+    """Общий на процесс кэш заготовок карточек"""
+    return CardTemplateCache()
+
+
+class EncodedImage(NamedTuple):
+    """Закодированная карточка и стоимость кодирования"""
+    data: bytes
+    format: str
+    mime: str
+    extension: str
+    encode_ms: float
+    size_bytes: int
+
+
+class CardEncoder:
+    """
+    Кодировщик карточек
+
+    Форматы:
+        png          — полноцветный PNG
+        png-palette  — PNG с адаптивной палитрой (P-режим): карточка состоит из
+                       нескольких цветов и сглаживания, поэтому 256 цветов хватает
+        webp         — WebP без потерь
+        jpeg         — JPEG
+
+    compress_level (0–9) задает компромисс скорость/размер для PNG и WebP.
+    """
+
+    FORMATS = {
+        "png": ("PNG", "image/png", "png"),
+        "png-palette": ("PNG", "image/png", "png"),
+        "webp": ("WEBP", "image/webp", "webp"),
+        "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    }
+
+    def __init__(self, image_format: str = "png", compress_level: int | None = None, palette_colors: int = 256, quality: int = 90):
+        if image_format not in self.FORMATS:
+            raise ValueError(f"Неизвестный формат изображений: {image_format}")
+        if compress_level is not None and not 0 <= compress_level <= 9:
+            raise ValueError("compress_level должен быть от 0 до 9")
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.palette_colors = palette_colors
+        self.quality = quality
+
+    def _save_options(self) -> Dict:
+        if self.image_format == "webp":
+            options = {"lossless": True}
+            if self.compress_level is not None:
+                options["method"] = min(6, max(1, round(self.compress_level * 6 / 9)))
+            return options
+        if self.image_format == "jpeg":
+            return {"quality": self.quality, "subsampling": 0}
+        if self.compress_level is not None:
+            return {"compress_level": self.compress_level}
+        return {}
+
+    def encode(self, image: Image.Image) -> EncodedImage:
+        """Кодирует изображение и замеряет время"""
+        pil_format, mime, extension = self.FORMATS[self.image_format]
+        started = time.perf_counter()
+        if self.image_format == "png-palette":
+            image = image.quantize(
+                colors=self.palette_colors,
+                method=Image.Quantize.FASTOCTREE,
+                dither=Image.Dither.NONE,
+            )
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, **self._save_options())
+        data = buffer.getvalue()
+        encode_ms = (time.perf_counter() - started) * 1000
+        return EncodedImage(data, self.image_format, mime, extension, encode_ms, len(data))
+
+
+# Размеры карточек для разных мест публикации: лента, портрет, сторис
+CARD_SIZES = {
+    "square": (1080, 1080),
+    "portrait": (1080, 1350),
+    "story": (1080, 1920),
+}
+
+# Ширина превью, которое показывает просмотрщик (половина карточки)
+PREVIEW_WIDTH = 540
+
+
+class ImageGenerator:
+    """Генератор изображений с наложением текста"""
+
+    DEFAULT_COLORS = {
+        'background': '#1a1a2e',
+        'role': '#e94560',
+        'text': '#ffffff',
+        'accent': '#0f3460'
+    }
+    
+    def __init__(
+        self,
+        width: int = 1080,
+        height: int = 1080,
+        metrics: TextMetricsCache | None = None,
+        layout_mode: str = "greedy",
+        fit_text: bool = False,
+        min_font_size: int = 24,
+        colors: Dict[str, str] | None = None,
+        background: str | Tuple[str, str] | None = None,
+        templates: CardTemplateCache | None = None,
+        image_format: str = "png",
+        compress_level: int | None = None,
+        extra_sizes: Tuple[str, ...] = (),
+        preview_width: int | None = None,
+    ):
+        unknown = [name for name in extra_sizes if name not in CARD_SIZES]
+        if unknown:
+            raise ValueError(f"Неизвестный размер карточки: {', '.join(unknown)}")
+        self.width = width
+        self.height = height
+        self.padding = 160
+        self.font_size = 45
+        self.line_spacing = 20
+        self.counter_gap = 40
+        self.fit_text = fit_text
+        self.min_font_size = min_font_size
+        self.metrics = metrics or get_text_metrics()
+        self.layout_engine = TextLayoutEngine(self.metrics, self._should_keep_with_next, mode=layout_mode)
+        self.colors = dict(self.DEFAULT_COLORS)
+        if colors:
+            self.colors.update(colors)
+        self.background = background
+        self.templates = templates or get_card_templates()
+        self.encoder = CardEncoder(image_format, compress_level)
+        # Дополнительные размеры рисуются из той же верстки, что и основная карточка
+        self.extra_sizes = tuple(name for name in extra_sizes if CARD_SIZES[name] != (width, height))
+        self.preview_width = preview_width
+        self.parallel_threshold = 3
+        # Параметры, по которым рабочий процесс воссоздает такой же генератор
+        self._options = {
+            "width": width,
+            "height": height,
+            "layout_mode": layout_mode,
+            "fit_text": fit_text,
+            "min_font_size": min_font_size,
+            "colors": dict(self.colors),
+            "background": background,
+            "image_format": image_format,
+            "compress_level": compress_level,
+            "extra_sizes": list(self.extra_sizes),
+            "preview_width": preview_width,
+        }
+        self._card_key_salt = self._render_fingerprint()
+
+    def _render_fingerprint(self) -> str:
+        """Все, кроме реплики и номера, от чего зависят байты карточки: параметры, шрифты, фон"""
+        def file_stamp(path) -> list:
+            try:
+                stat = os.stat(path)
+            except (OSError, TypeError):
+                return [path]
+            return [path, stat.st_size, stat.st_mtime_ns]
+
+        background = self.background
+        if isinstance(background, str) and not _is_color(background):
+            background = file_stamp(background)
+        fonts = [file_stamp(FONT_FILES[bold]) for bold in (False, True)]
+        return json.dumps([self._options, fonts, background], sort_keys=True, ensure_ascii=False)
+
+    def card_key(self, role: str, text: str, card_number: int, total_cards: int) -> str:
+        """Хэш всех входов карточки: одинаковый ключ — одинаковые байты"""
+        digest = hashlib.sha256(self._card_key_salt.encode("utf-8"))
+        digest.update(json.dumps([role, text, card_number, total_cards], ensure_ascii=False).encode("utf-8"))
+        return digest.hexdigest()
+        
+    def _get_font(self, size: int, bold: bool = False):
+        """Возвращает шрифт DejaVu Sans (поддерживает кириллицу и латиницу)"""
+        return self.metrics.font(size, bold)
+
+    def _format_sentences(self, text: str) -> str:
+        """Убирает лишние пробелы перед знаками препинания и переносит предложения на новую строку"""
+        text = re.sub(r'\s+([,.;!?])', r'\1', text)
+        text = re.sub(r'\s{2,}', ' ', text)
+        text = re.sub(r'([.!?])\s+(?=[^\s])', r'\1\n', text)
+        return text.strip()
+    
+    def _parse_markdown(self, text: str) -> List[tuple]:
+        """
+        Простой парсер markdown для **жирного** и *курсива*
+        Возвращает список кортежей (текст, стиль)
+        """
+        result = []
+        i = 0
+        current_text = ""
+        
+        while i < len(text):
+            if i < len(text) - 1 and text[i:i+2] == '**':
+                if current_text:
+                    result.append((current_text, 'normal'))
+                    current_text = ""
+                # Ищем закрывающие **
+                end = text.find('**', i + 2)
+                if end != -1:
+                    content = text[i+2:end]
+                    # Удаляем пробелы перед знаками препинания
+                    content = re.sub(r'\s+([,.;!?])', r'\1', content)
+                    result.append((content, 'bold'))
+                    i = end + 2
+                else:
+                    current_text += text[i]
+                    i += 1
+            elif text[i] == '*':
+                if current_text:
+                    result.append((current_text, 'normal'))
+                    current_text = ""
+                # Ищем закрывающий *
+                end = text.find('*', i + 1)
+                if end != -1:
+                    content = text[i+1:end]
+                    content = re.sub(r'\s+([,.;!?])', r'\1', content)
+                    result.append((content, 'italic'))
+                    i = end + 1
+                else:
+                    current_text += text[i]
+                    i += 1
+            else:
+                current_text += text[i]
+                i += 1
+        
+        if current_text:
+            clean_text = re.sub(r'\s+([,.;!?])', r'\1', current_text)
+            result.append((clean_text, 'normal'))
+            
+        return result if result else [(re.sub(r'\s+([,.;!?])', r'\1', text), 'normal')]
+    
+    def _should_keep_with_next(self, word: str) -> bool:
+        """Проверяет, нужно ли держать слово вместе со следующим"""
+        short_words = {'и', 'в', 'на', 'с', 'по', 'за', 'из', 'о', 'у', 'к', 'до', 'от', 'не'}
+        return word.lower() in short_words or len(word) <= 2
+    
+    def _ends_with_punctuation(self, word: str) -> bool:
+        """Проверяет, заканчивается ли слово знаком препинания"""
+        return word and word[-1] in '.,!?;:—-'
+    
+    def _split_word_and_punctuation(self, word: str) -> tuple:
+        """Отделяет знаки препинания от слова"""
+        if not word:
+            return '', ''
+        
+        punctuation = ''
+        text = word
+        
+        # Собираем знаки препинания с конца
+        while text and text[-1] in '.,!?;:—-':
+            punctuation = text[-1] + punctuation
+            text = text[:-1]
+        
+        return text, punctuation
+    
+    def _tokenize(self, text: str) -> List[tuple]:
+        """
+        Разбивает реплику на токены (слово, стиль) для верстки
+
+        Знаки препинания остаются при слове; разрыв абзаца — токен (None, 'newline').
+        """
+        text = self._format_sentences(text)
+        tokens = []
+        for segment, style in self._parse_markdown(text):
+            parts = segment.split('\n')
+            for part_index, part in enumerate(parts):
+                for word in part.split():
+                    word_text, punctuation = self._split_word_and_punctuation(word)
+                    if word_text or punctuation:
+                        tokens.append((word_text + punctuation, style))
+                if part_index < len(parts) - 1:
+                    tokens.append((None, 'newline'))
+        return tokens
+    
+    def _line_spacing(self, font_size: int) -> int:
+        """Межстрочный интервал пропорционально размеру шрифта"""
+        return round(self.line_spacing * font_size / self.font_size)
+
+    def _fit_text(self, text: str, max_width: int, max_height: int) -> TextFit:
+        """Верстает текст базовым размером или подбирает размер под область (fit_text)"""
+        metrics = get_stage_metrics()
+        with metrics.timer("markdown"):
+            tokens = self._tokenize(text)
+        with metrics.timer("layout"):
+            if self.fit_text:
+                return self.layout_engine.fit(
+                    tokens,
+                    max_width,
+                    max_height,
+                    min(self.min_font_size, self.font_size),
+                    self.font_size,
+                    self._line_spacing,
+                )
+            layout = self.layout_engine.layout(tokens, self.font_size, max_width, self.line_spacing)
+        overflow = layout.height > max_height or any(line.width > max_width for line in layout.lines)
+        return TextFit(layout, self.font_size, overflow)
+
+    def create_card(self, role: str, text: str, card_number: int, total_cards: int) -> Image.Image:
+        """Создает одну карточку с репликой"""
+        card, _ = self.render_card(role, text, card_number, total_cards)
+        return card
+
+    def render_card(self, role: str, text: str, card_number: int, total_cards: int) -> Tuple[Image.Image, TextFit]:
+        """Создает карточку и возвращает ее вместе с выбранным размером шрифта и признаком переполнения"""
+        with get_stage_metrics().timer("create_card"):
+            img, fit = self.render_card_body(role, text)
+            self.draw_counter(img, card_number, total_cards)
+        return img, fit
+
+    def render_card_body(
+        self,
+        role: str,
+        text: str,
+        size: Tuple[int, int] | None = None,
+        fit: TextFit | None = None,
+    ) -> Tuple[Image.Image, TextFit]:
+        """
+        Создает карточку без счетчика
+
+        Область текста не зависит от чисел в счетчике, поэтому его можно
+        дорисовать позже (draw_counter), когда станет известно число карточек.
+
+        Args:
+            size: размер холста, если он отличается от основного (другой формат)
+            fit: готовая верстка текста той же ширины — тогда текст не
+                верстается заново, а блок опускается к середине более высокого холста
+        """
+        width, height = size or (self.width, self.height)
+        y_shift = (height - self.height) // 2 if fit is not None else 0
+
+        # Шрифты
+        role_font = self._get_font(60, bold=True)
+        
+        padding = self.padding
+        y_position = padding + y_shift
+        
+        # Рисуем роль
+        role_bbox = self.metrics.text_bbox(role, 60, bold=True)
+        role_width = role_bbox[2] - role_bbox[0]
+        role_x = (width - role_width) // 2
+        role_y = y_position
+        y_position += (role_bbox[3] - role_bbox[1]) + 60
+        
+        # Фон и разделитель берем из готовой заготовки
+        line_margin = 200
+        divider = ((line_margin, y_position), (width - line_margin, y_position), 3)
+        metrics = get_stage_metrics()
+        with metrics.timer("template"):
+            img = self.templates.get((width, height), self.colors, divider, self.background)
+        draw = ImageDraw.Draw(img)
+
+        with metrics.timer("raster"):
+            draw.text((role_x, role_y), role, fill=self.colors['role'], font=role_font)
+        y_position += 120
+        
+        if fit is None:
+            # Текст заканчивается над счетчиком карточек
+            counter_top = height - padding + self.metrics.text_bbox("0/0", 30)[1]
+
+            # Верстаем текст с форматированием
+            max_width = width - (padding * 2)
+            max_height = counter_top - self.counter_gap - y_position
+            fit = self._fit_text(text, max_width, max_height)
+        text_font = self._get_font(fit.font_size)
+        text_font_bold = self._get_font(fit.font_size, bold=True)
+
+        with metrics.timer("raster"):
+            for line in fit.layout.lines:
+                line_x = (width - line.width) // 2
+                for run in line.runs:
+                    current_font = text_font_bold if run.style == 'bold' else text_font
+                    draw.text((line_x + run.x, y_position + line.y), run.text,
+                              fill=self.colors['text'], font=current_font)
+        
+        return img, fit
+
+    def draw_counter(self, img: Image.Image, card_number: int, total_cards: int) -> None:
+        """Рисует счетчик карточек внизу"""
+        counter_font = self._get_font(30)
+        counter_text = f"{card_number}/{total_cards}"
+        counter_bbox = self.metrics.text_bbox(counter_text, 30)
+        counter_x = (img.width - (counter_bbox[2] - counter_bbox[0])) // 2
+        counter_y = img.height - self.padding
+        
+        with get_stage_metrics().timer("counter"):
+            draw = ImageDraw.Draw(img)
+            draw.text((counter_x, counter_y), counter_text, 
+                      fill=self.colors['accent'], font=counter_font)
+
+    def render_card_size(
+        self, role: str, text: str, card_number: int, total_cards: int, size: Tuple[int, int], fit: TextFit
+    ) -> Tuple[Image.Image, TextFit]:
+        """
+        Рисует карточку другого размера по верстке основной
+
+        Верстка переиспользуется, если ширина та же, а холст не ниже основного;
+        иначе текст верстается под новый размер.
+        """
+        shared = size[0] == self.width and size[1] >= self.height
+        img, size_fit = self.render_card_body(role, text, size=size, fit=fit if shared else None)
+        self.draw_counter(img, card_number, total_cards)
+        return img, size_fit
+
+    def render_preview(self, card_img: Image.Image) -> Image.Image | None:
+        """Уменьшенная копия карточки для просмотра; None, если превью не нужно"""
+        if not self.preview_width or self.preview_width >= card_img.width:
+            return None
+        height = round(card_img.height * self.preview_width / card_img.width)
+        with get_stage_metrics().timer("preview"):
+            return card_img.resize((self.preview_width, height), Image.Resampling.BOX)
+
+    def render_thread(
+        self,
+        thread_content: Dict,
+        mode: str = "auto",
+        on_card: Callable[[int, int], None] | None = None,
+    ) -> List[Dict]:
+        """
+        Рендерит и кодирует все карточки треда, сохраняя порядок реплик
+
+        Args:
+            thread_content: словарь в формате generate_thread_content
+            mode: "process" — пул процессов, "thread" — пул потоков,
+                "serial" — по очереди, "auto" — serial для коротких тредов,
+                иначе process
+            on_card: вызывается с (готово, всего) после каждой карточки
+
+        Returns:
+            Список словарей карточек (role, text, bytes, width, height, font_size,
+            overflow, format, mime, extension, encode_ms, size_bytes, card_key)
+        """
+        return self.render_cards(self.thread_jobs(thread_content), mode, on_card)
+
+    @staticmethod
+    def thread_jobs(thread_content: Dict) -> List[Tuple[str, str, int, int]]:
+        """Задания (роль, текст, номер, всего) для всех реплик треда"""
+        replies = thread_content.get("replies", [])
+        total_cards = len(replies)
+        return [
+            (reply.get("role", f"Реплика {idx}"), reply.get("text", ""), idx, total_cards)
+            for idx, reply in enumerate(replies, start=1)
+        ]
+
+    def render_cards(
+        self,
+        jobs: List[Tuple[str, str, int, int]],
+        mode: str = "auto",
+        on_card: Callable[[int, int], None] | None = None,
+    ) -> List[Dict]:
+        """Рендерит и кодирует произвольный набор карточек (например, только измененные)"""
+        if mode == "auto":
+            mode = "serial" if len(jobs) < self.parallel_threshold else "process"
+        if mode not in RENDER_MODES:
+            raise ValueError(f"Неизвестный режим рендеринга: {mode}")
+
+        if mode == "process":
+            cards = self._render_in_processes(jobs, on_card)
+        else:
+            if mode == "serial":
+                results = (render_card_payload(self, *job) for job in jobs)
+            else:
+                executor = get_render_executor("thread")
+                results = executor.map(lambda job: render_card_payload(self, *job), jobs)
+            cards = []
+            for card in results:
+                cards.append(card)
+                if on_card:
+                    on_card(len(cards), len(jobs))
+        for card, job in zip(cards, jobs):
+            card["card_key"] = self.card_key(*job)
+        return cards
+
+    def _render_in_processes(
+        self, jobs: List[Tuple[str, str, int, int]], on_card: Callable[[int, int], None] | None = None
+    ) -> List[Dict]:
+        executor = get_render_executor("process")
+        try:
+            futures = [executor.submit(_render_card_job, self._options, *job) for job in jobs]
+            cards = []
+            # Замеры рабочих процессов приезжают вместе с карточками
+            metrics = get_stage_metrics()
+            for future in futures:
+                card = future.result()
+                metrics.merge(card.pop("metrics", []))
+                cards.append(card)
+                if on_card:
+                    on_card(len(cards), len(jobs))
+            return cards
+        except BrokenProcessPool:
+            # Пул сломан (например, упал рабочий процесс) — пересоздадим его в следующий раз
+            get_render_executor.cache_clear()
+            return [render_card_payload(self, *job) for job in jobs]
+
+
+RENDER_MODES = ("auto", "process", "thread", "serial")
+
+# Генераторы внутри рабочих процессов пула: по одному на набор параметров,
+# шрифты и заготовки остаются загруженными между задачами. Наборов немного,
+# поэтому хватает небольшого LRU: давно не встречавшиеся параметры вытесняются
+_WORKER_GENERATORS_MAX = 4
+_worker_generators: "OrderedDict[str, ImageGenerator]" = OrderedDict()
+
+
+def render_card_payload(generator: ImageGenerator, role: str, text: str, card_number: int, total_cards: int) -> Dict:
+    """Рендерит одну карточку и кодирует ее кодировщиком генератора"""
+    card_img, text_fit = generator.render_card(role, text, card_number, total_cards)
+    card = _encode_card_payload(generator, role, text, card_img, text_fit)
+    _add_card_variants(card, generator, card_number, total_cards, card_img, text_fit)
+    return card
+
+
+def _encode_image(generator: ImageGenerator, img: Image.Image, text_fit: TextFit | None = None) -> Dict:
+    """Кодирует изображение кодировщиком генератора и описывает результат"""
+    with get_stage_metrics().timer("encode"):
+        encoded = generator.encoder.encode(img)
+    info = {
+        "bytes": encoded.data,
+        "width": img.width,
+        "height": img.height,
+        "format": encoded.format,
+        "mime": encoded.mime,
+        "extension": encoded.extension,
+        "encode_ms": encoded.encode_ms,
+        "size_bytes": encoded.size_bytes,
+    }
+    if text_fit is not None:
+        info["font_size"] = text_fit.font_size
+        info["overflow"] = text_fit.overflow
+    return info
+
+
+def _encode_card_payload(generator: ImageGenerator, role: str, text: str, card_img: Image.Image, text_fit: TextFit) -> Dict:
+    """Кодирует готовую карточку и собирает ее описание"""
+    return {"role": role, "text": text, **_encode_image(generator, card_img, text_fit)}
+
+
+def _add_card_variants(
+    card: Dict,
+    generator: ImageGenerator,
+    card_number: int,
+    total_cards: int,
+    card_img: Image.Image,
+    text_fit: TextFit,
+) -> None:
+    """
+    Добавляет к карточке другие размеры и превью (card["variants"])
+
+    Все варианты рисуются из уже сверстанного текста основной карточки,
+    повторяется только растеризация под другой холст.
+    """
+    variants = {}
+    for name in generator.extra_sizes:
+        img, size_fit = generator.render_card_size(
+            card["role"], card["text"], card_number, total_cards, CARD_SIZES[name], text_fit
+        )
+        variants[name] = _encode_image(generator, img, size_fit)
+    preview = generator.render_preview(card_img)
+    if preview is not None:
+        variants["preview"] = _encode_image(generator, preview)
+    if variants:
+        card["variants"] = variants
+
+
+def _render_card_job(options: Dict, role: str, text: str, card_number: int, total_cards: int) -> Dict:
+    """Задача рабочего процесса: берет (или создает) генератор для параметров и рендерит карточку"""
+    key = json.dumps(options, sort_keys=True)
+    generator = _worker_generators.get(key)
+    if generator is None:
+        generator = ImageGenerator(**options, metrics=TextMetricsCache(), templates=CardTemplateCache())
+        _worker_generators[key] = generator
+        while len(_worker_generators) > _WORKER_GENERATORS_MAX:
+            _worker_generators.popitem(last=False)
+    else:
+        _worker_generators.move_to_end(key)
+    payload = render_card_payload(generator, role, text, card_number, total_cards)
+    payload["metrics"] = get_stage_metrics().take_events()
+    return payload
+
+
+class StreamingCardRenderer:
+    """
+    Рисует карточки по мере поступления реплик из потокового ответа
+
+    Пока число реплик неизвестно, рисуется карточка без счетчика; в finish()
+    счетчики дорисовываются и карточки кодируются. Реплики, которые не
+    совпали с итоговым ответом, перерисовываются.
+    """
+
+    def __init__(self, generator: ImageGenerator, on_card: Callable[[int, Dict, Image.Image], None] | None = None):
+        self.generator = generator
+        self.on_card = on_card
+        self._bodies: List[Tuple[str, str, Image.Image, TextFit]] = []
+
+    def add_reply(self, reply: Dict) -> None:
+        """Обрабатывает очередную готовую реплику"""
+        index = len(self._bodies)
+        role = reply.get("role", f"Реплика {index + 1}")
+        text = reply.get("text", "")
+        card_img, text_fit = self.generator.render_card_body(role, text)
+        self._bodies.append((role, text, card_img, text_fit))
+        if self.on_card:
+            self.on_card(index, reply, card_img)
+
+    def finish(self, thread_content: Dict) -> List[Dict]:
+        """Дорисовывает счетчики и кодирует карточки итогового ответа"""
+        replies = thread_content.get("replies", [])
+        total_cards = len(replies)
+        cards = []
+        for idx, reply in enumerate(replies, start=1):
+            role = reply.get("role", f"Реплика {idx}")
+            text = reply.get("text", "")
+            if idx <= len(self._bodies) and self._bodies[idx - 1][:2] == (role, text):
+                _, _, card_img, text_fit = self._bodies[idx - 1]
+            else:
+                card_img, text_fit = self.generator.render_card_body(role, text)
+            self.generator.draw_counter(card_img, idx, total_cards)
+            card = _encode_card_payload(self.generator, role, text, card_img, text_fit)
+            _add_card_variants(card, self.generator, idx, total_cards, card_img, text_fit)
+            card["card_key"] = self.generator.card_key(role, text, idx, total_cards)
+            cards.append(card)
+        return cards
+
+
+@functools.lru_cache(maxsize=None)
+def get_render_executor(kind: str = "process") -> Executor:
+    """
+    Общий на процесс пул для рендеринга карточек
+
+    Процессы запускаются через spawn (безопасно рядом с потоками Streamlit)
+    и живут между запросами, поэтому стоимость запуска платится один раз.
+    """
+    workers = os.cpu_count() or 1
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="card-render")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
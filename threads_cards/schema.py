@@ -0,0 +1,201 @@
+"""Контракт формата поста: проверки и локальные исправления"""
+
+import re
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class SchemaIssue(NamedTuple):
+    """Нарушение формата поста"""
+    field: str  # "theme", "replies", "replies[3]", "tags", ...
+    message: str
+    local: bool  # исправляется без обращения к модели
+
+
+class ThreadSchema:
+    """
+    Проверка поста на контракт из DEFAULT_SYSTEM_PROMPT
+
+    Правила собираются один раз в кортеж функций-проверок (с заранее
+    скомпилированными регулярными выражениями), поэтому проверка — один
+    проход по посту без интерпретации схемы. repair_locally() исправляет
+    то, что не требует модели (пробелы, лишние реплики, CTA, хештеги,
+    language), и возвращает оставшиеся нарушения.
+    """
+
+    CYRILLIC = re.compile(r"[А-Яа-яЁё]")
+    # Оставшиеся нарушения можно отправить модели с REPAIR_SYSTEM_PROMPT
+    repairable = True
+
+    def __init__(
+        self,
+        min_replies: int = 6,
+        max_replies: int = 8,
+        max_theme_words: int = 4,
+        min_tags: int = 3,
+        max_tags: int = 5,
+        cta: str = "Укажи себя👇",
+        default_tags: Tuple[str, ...] = ("#ирония", "#threadsюмор", "#психология", "#мемы", "#коучинг"),
+        language: str = "ru",
+    ):
+        self.min_replies = min_replies
+        self.max_replies = max_replies
+        self.max_theme_words = max_theme_words
+        self.min_tags = min_tags
+        self.max_tags = max_tags
+        self.cta = cta
+        self.default_tags = default_tags
+        self.language = language
+        self._checks = (self._check_theme, self._check_replies, self._check_cta, self._check_tags, self._check_language)
+
+    def check(self, content) -> List[SchemaIssue]:
+        """Все нарушения формата (пустой список — пост корректен)"""
+        if not isinstance(content, dict):
+            return [SchemaIssue("post", "пост должен быть JSON-объектом", False)]
+        issues = []
+        for check in self._checks:
+            issues.extend(check(content))
+        return issues
+
+    def _check_theme(self, content: Dict) -> List[SchemaIssue]:
+        theme = content.get("theme")
+        if not isinstance(theme, str) or not theme.strip():
+            return [SchemaIssue("theme", "нет темы (theme)", False)]
+        if theme != theme.strip():
+            return [SchemaIssue("theme", "лишние пробелы в теме", True)]
+        if len(theme.split()) > self.max_theme_words:
+            return [SchemaIssue("theme", f"тема длиннее {self.max_theme_words} слов", False)]
+        return []
+
+    def _check_replies(self, content: Dict) -> List[SchemaIssue]:
+        replies = content.get("replies")
+        if not isinstance(replies, list) or not replies:
+            return [SchemaIssue("replies", "нет реплик (replies)", False)]
+        issues = []
+        if len(replies) < self.min_replies:
+            issues.append(SchemaIssue(
+                "replies", f"реплик должно быть от {self.min_replies} до {self.max_replies}, получено {len(replies)}", False
+            ))
+        elif len(replies) > self.max_replies:
+            issues.append(SchemaIssue("replies", f"реплик больше {self.max_replies}", True))
+
+        roles = set()
+        for idx, reply in enumerate(replies, start=1):
+            field = f"replies[{idx}]"
+            if not isinstance(reply, dict):
+                issues.append(SchemaIssue(field, f"реплика {idx} должна быть объектом с role и text", False))
+                continue
+            role, text = reply.get("role"), reply.get("text")
+            if not isinstance(role, str) or not role.strip() or not isinstance(text, str) or not text.strip():
+                issues.append(SchemaIssue(field, f"в реплике {idx} нет роли или текста", False))
+                continue
+            if role != role.strip() or text != text.strip():
+                issues.append(SchemaIssue(field, f"лишние пробелы в реплике {idx}", True))
+            if not self.CYRILLIC.search(text):
+                issues.append(SchemaIssue(field, f"реплика {idx} не на русском языке", False))
+            role_key = role.strip().casefold()
+            if role_key in roles:
+                issues.append(SchemaIssue(field, f"роль «{role.strip()}» в реплике {idx} повторяется", False))
+            roles.add(role_key)
+        return issues
+
+    def _check_cta(self, content: Dict) -> List[SchemaIssue]:
+        if content.get("cta") != self.cta:
+            return [SchemaIssue("cta", f"cta должен быть «{self.cta}»", True)]
+        return []
+
+    def _check_tags(self, content: Dict) -> List[SchemaIssue]:
+        tags = content.get("tags")
+        if (
+            not isinstance(tags, list)
+            or not self.min_tags <= len(tags) <= self.max_tags
+            or not all(isinstance(tag, str) and tag.startswith("#") and " " not in tag for tag in tags)
+            or len(set(tags)) != len(tags)
+        ):
+            return [SchemaIssue("tags", f"нужно {self.min_tags}–{self.max_tags} разных хештегов", True)]
+        return []
+
+    def _check_language(self, content: Dict) -> List[SchemaIssue]:
+        if content.get("language") != self.language:
+            return [SchemaIssue("language", f"language должен быть «{self.language}»", True)]
+        return []
+
+    def repair_locally(self, content: Dict) -> List[SchemaIssue]:
+        """Исправляет пост на месте там, где не нужна модель; возвращает оставшиеся нарушения"""
+        if not isinstance(content, dict):
+            return self.check(content)
+        if isinstance(content.get("theme"), str):
+            content["theme"] = content["theme"].strip()
+
+        replies = content.get("replies")
+        if isinstance(replies, list):
+            for reply in replies:
+                if isinstance(reply, dict):
+                    for key in ("role", "text"):
+                        if isinstance(reply.get(key), str):
+                            reply[key] = reply[key].strip()
+            if len(replies) > self.max_replies:
+                # Первая реплика — тема, последняя — панчлайн; лишние убираем из середины
+                content["replies"] = replies[:self.max_replies - 1] + replies[-1:]
+
+        content["cta"] = self.cta
+        content["language"] = self.language
+
+        tags = []
+        raw_tags = content.get("tags")
+        for tag in raw_tags if isinstance(raw_tags, list) else []:
+            if isinstance(tag, str) and tag.strip("# "):
+                tag = "#" + "".join(tag.strip("# ").split())
+                if tag not in tags:
+                    tags.append(tag)
+        for tag in self.default_tags:
+            if len(tags) >= self.min_tags:
+                break
+            if tag not in tags:
+                tags.append(tag)
+        content["tags"] = tags[:self.max_tags]
+
+        return [issue for issue in self.check(content) if not issue.local]
+
+
+class RenderableSchema:
+    """
+    Минимальный контракт для системного промпта оператора
+
+    Свой промпт задает свои тему, число реплик, язык, CTA и теги, поэтому
+    проверяется только то, без чего нельзя нарисовать карточки: непустой
+    список реплик с ролью и текстом. Исправляются только лишние пробелы,
+    запрос на исправление к модели не отправляется.
+    """
+
+    repairable = False
+
+    def check(self, content) -> List[SchemaIssue]:
+        """Нарушения, мешающие рисованию (пустой список — пост годится)"""
+        if not isinstance(content, dict):
+            return [SchemaIssue("post", "пост должен быть JSON-объектом", False)]
+        replies = content.get("replies")
+        if not isinstance(replies, list) or not replies:
+            return [SchemaIssue("replies", "нет реплик (replies)", False)]
+        issues = []
+        for idx, reply in enumerate(replies, start=1):
+            if not isinstance(reply, dict) or not all(
+                isinstance(reply.get(key), str) and reply[key].strip() for key in ("role", "text")
+            ):
+                issues.append(SchemaIssue(f"replies[{idx}]", f"в реплике {idx} нет роли или текста", False))
+        return issues
+
+    def repair_locally(self, content: Dict) -> List[SchemaIssue]:
+        """Убирает лишние пробелы; возвращает оставшиеся нарушения"""
+        if isinstance(content, dict):
+            if isinstance(content.get("theme"), str):
+                content["theme"] = content["theme"].strip()
+            for reply in content.get("replies") if isinstance(content.get("replies"), list) else []:
+                if isinstance(reply, dict):
+                    for key in ("role", "text"):
+                        if isinstance(reply.get(key), str):
+                            reply[key] = reply[key].strip()
+        return self.check(content)
+
+
+THREAD_SCHEMA = ThreadSchema()
+RENDERABLE_SCHEMA = RenderableSchema()
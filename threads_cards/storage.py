@@ -0,0 +1,616 @@
+"""Хранилище карточек, ZIP-архивы и архив подборок"""
+
+import functools
+import hashlib
+import io
+import json
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+import zipfile
+from collections import OrderedDict
+from contextlib import closing
+from typing import BinaryIO, Dict, List, Tuple
+
+from .metrics import get_stage_metrics
+from .render import CARD_SIZES, PREVIEW_WIDTH, ImageGenerator
+
+
+def sanitize_filename(value: str) -> str:
+    """Создает безопасное имя файла на основе темы"""
+    safe_chars = "_- "
+    cleaned = "".join(ch if ch.isalnum() or ch in safe_chars else "_" for ch in value)
+    collapsed = "_".join(filter(None, cleaned.split()))
+    return collapsed[:80] or "thread"
+
+
+class CardBlobStore:
+    """
+    Контентно-адресуемое хранилище карточек на локальном диске
+
+    Файл называется хэшем (sha256) своего содержимого, поэтому одинаковые
+    карточки хранятся один раз. В session_state остается только ключ.
+    Общий размер ограничен max_bytes: при превышении удаляются давно не
+    читавшиеся файлы (LRU по времени последнего обращения).
+    """
+
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self) -> None:
+        """Восстанавливает индекс по файлам на диске, от самых старых к новым"""
+        entries = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(directory, filename))
+                entries.append((stat.st_mtime, filename, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, data: bytes) -> str:
+        """Сохраняет данные и возвращает их ключ"""
+        key = hashlib.sha256(data).hexdigest()
+        path = self._path(key)
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+                os.utime(path)
+                return key
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, "wb") as blob_file:
+            blob_file.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if key not in self._index:
+                self._total_bytes += len(data)
+            self._index[key] = len(data)
+            self._index.move_to_end(key)
+            self._evict()
+        return key
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _touch(self, key: str) -> str:
+        path = self._path(key)
+        with self._lock:
+            if key not in self._index:
+                raise KeyError(key)
+            self._index.move_to_end(key)
+        os.utime(path)
+        return path
+
+    def get(self, key: str) -> bytes:
+        """Читает данные по ключу; KeyError, если они удалены из хранилища"""
+        try:
+            with open(self._touch(key), "rb") as blob_file:
+                return blob_file.read()
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+    def view(self, key: str) -> mmap.mmap:
+        """Отображает файл в память только для чтения (для отдачи без копирования)"""
+        try:
+            with open(self._touch(key), "rb") as blob_file:
+                return mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._index
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+
+@functools.lru_cache(maxsize=None)
+def get_blob_store() -> CardBlobStore:
+    """Общее на процесс хранилище карточек (каталог и лимит задаются переменными окружения)"""
+    root = os.getenv("THREADS_CARDS_BLOB_DIR") or os.path.join(tempfile.gettempdir(), "threads_cards_blobs")
+    max_megabytes = int(os.getenv("THREADS_CARDS_BLOB_MAX_MB", "1024"))
+    return CardBlobStore(root, max_megabytes * 1024 * 1024)
+
+
+class CardRenderCache:
+    """
+    Готовые карточки по хэшу их входов (ImageGenerator.card_key)
+
+    Хранит описания карточек с ключом blob — сами байты лежат в
+    CardBlobStore, поэтому кэш легкий. Запись, чей файл уже вытеснен из
+    хранилища, считается промахом.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, card_key: str) -> Dict | None:
+        with self._lock:
+            image_info = self._entries.get(card_key)
+            if image_info is None:
+                return None
+            blobs = [image_info["blob"]] + [variant["blob"] for variant in image_info.get("variants", {}).values()]
+            store = get_blob_store()
+            if any(blob not in store for blob in blobs):
+                del self._entries[card_key]
+                return None
+            self._entries.move_to_end(card_key)
+            return dict(image_info)
+
+    def put(self, image_info: Dict) -> None:
+        """Запоминает карточку, уже перенесенную в хранилище (есть card_key и blob)"""
+        if "card_key" not in image_info or "blob" not in image_info:
+            return
+        with self._lock:
+            self._entries[image_info["card_key"]] = {k: v for k, v in image_info.items() if k != "bytes"}
+            self._entries.move_to_end(image_info["card_key"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_card_render_cache() -> CardRenderCache:
+    """Общий на процесс кэш готовых карточек"""
+    return CardRenderCache()
+
+
+def store_images(images: List[Dict]) -> List[Dict]:
+    """Переносит байты карточек в хранилище, оставляя в словарях только ключ blob"""
+    store = get_blob_store()
+    render_cache = get_card_render_cache()
+    stored = []
+    for image_info in images:
+        image_info = dict(image_info)
+        if "bytes" in image_info:
+            data = image_info.pop("bytes")
+            image_info["blob"] = store.put(data)
+            image_info.setdefault("size_bytes", len(data))
+        if "variants" in image_info:
+            variants = {}
+            for name, variant in image_info["variants"].items():
+                variant = dict(variant)
+                if "bytes" in variant:
+                    variant["blob"] = store.put(variant.pop("bytes"))
+                variants[name] = variant
+            image_info["variants"] = variants
+        render_cache.put(image_info)
+        stored.append(image_info)
+    return stored
+
+
+def render_thread_incremental(image_generator: ImageGenerator, thread_content: Dict) -> Tuple[List[Dict], int]:
+    """
+    Рисует только карточки, входы которых изменились; остальные берет из кэша
+
+    Returns:
+        (карточки треда с ключами blob, число перерисованных карточек)
+    """
+    render_cache = get_card_render_cache()
+    jobs = image_generator.thread_jobs(thread_content)
+    images = [render_cache.get(image_generator.card_key(*job)) for job in jobs]
+    missing = [idx for idx, image_info in enumerate(images) if image_info is None]
+    if missing:
+        rendered = store_images(image_generator.render_cards([jobs[idx] for idx in missing]))
+        for idx, image_info in zip(missing, rendered):
+            images[idx] = image_info
+    return images, len(missing)
+
+
+# Параметры рисования, которые хранит подборка: по ним карточки можно перерисовать
+RENDER_OPTION_FIELDS = ("colors", "image_format", "compress_level", "extra_sizes", "preview_width")
+
+
+def batch_image_generator(batch: Dict, **overrides) -> ImageGenerator:
+    """Генератор с параметрами, которыми рисовалась подборка (overrides — правки параметров)"""
+    images = batch.get("images") or [{}]
+    options = dict(
+        fit_text=True,
+        colors=batch.get("colors"),
+        image_format=batch.get("image_format") or images[0].get("format", "png"),
+        compress_level=batch.get("compress_level"),
+        extra_sizes=tuple(batch.get("extra_sizes") or ()),
+        preview_width=batch.get("preview_width", PREVIEW_WIDTH),
+    )
+    options.update(overrides)
+    return ImageGenerator(**options)
+
+
+def _has_blobs(image_info: Dict) -> bool:
+    """Все байты карточки (включая размеры и превью) есть в словаре или в хранилище"""
+    store = get_blob_store()
+    parts = [image_info] + list(image_info.get("variants", {}).values())
+    return all("bytes" in part or part.get("blob") in store for part in parts)
+
+
+def restore_images(batch: Dict, positions: List[int] | None = None) -> int:
+    """
+    Перерисовывает карточки подборки, вытесненные из хранилища (без обращения к модели)
+
+    Генератор собирается из сохраненных параметров подборки, новые ключи
+    blob записываются в подборку и в архив.
+
+    Args:
+        positions: какие карточки проверить (по умолчанию — все)
+
+    Returns:
+        Число перерисованных карточек
+    """
+    images = batch["images"]
+    if positions is None:
+        positions = range(len(images))
+    missing = [idx for idx in positions if not _has_blobs(images[idx])]
+    if not missing:
+        return 0
+
+    jobs = [(images[idx]["role"], images[idx].get("text", ""), idx + 1, len(images)) for idx in missing]
+    restored = store_images(batch_image_generator(batch).render_cards(jobs))
+    for idx, image_info in zip(missing, restored):
+        images[idx] = image_info
+    batch["content_hash"] = batch_content_hash(images, batch["theme"])
+    get_batch_archive().save_images(batch["id"], images, batch["content_hash"])
+    return len(missing)
+
+
+def image_bytes(image_info: Dict) -> bytes:
+    """Байты карточки: из словаря или из хранилища по ключу"""
+    if "bytes" in image_info:
+        return image_info["bytes"]
+    return get_blob_store().get(image_info["blob"])
+
+
+def _size_variants(image_info: Dict) -> List[Tuple[str, Dict]]:
+    """Другие размеры карточки (без превью) в порядке CARD_SIZES"""
+    variants = image_info.get("variants", {})
+    return [(name, variants[name]) for name in CARD_SIZES if name in variants]
+
+
+# Форматы карточек уже сжаты, повторный deflate только тратит CPU
+COMPRESSED_EXTENSIONS = {"png", "webp", "jpg"}
+
+
+def write_images(zip_file: zipfile.ZipFile, images: List[Dict], theme: str, folder: str = "") -> None:
+    """Записывает карточки одной генерации в открытый ZIP (при необходимости — в папку folder)"""
+    for idx, image_info in enumerate(images, start=1):
+        extension = image_info.get("extension", "png")
+        # Роль приходит из ответа модели или от клиента сервиса — в имя файла только безопасные символы
+        filename = f"{sanitize_filename(theme)}_{idx:02d}_{sanitize_filename(image_info['role'])}.{extension}"
+        compression = zipfile.ZIP_STORED if extension in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        zip_file.writestr(folder + filename, image_bytes(image_info), compress_type=compression)
+        # Другие размеры лежат в папках по названию размера
+        for name, variant in _size_variants(image_info):
+            zip_file.writestr(f"{folder}{name}/{filename}", image_bytes(variant), compress_type=compression)
+
+
+def images_to_zip(images: List[Dict], theme: str, target: BinaryIO | None = None) -> BinaryIO:
+    """Упаковывает изображения одной генерации в ZIP (в target или в новый BytesIO)"""
+    zip_buffer = target if target is not None else io.BytesIO()
+    with get_stage_metrics().timer("zip"), zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        write_images(zip_file, images, theme)
+    zip_buffer.seek(0)
+    return zip_buffer
+
+
+def write_zip(path: str, images: List[Dict], theme: str) -> None:
+    """Пишет архив атомарно, чтобы прерванный запуск не оставил битый ZIP"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as zip_file:
+        images_to_zip(images, theme, zip_file)
+    os.replace(temp_path, path)
+
+
+def batch_content_hash(images: List[Dict], theme: str) -> str:
+    """Хэш содержимого подборки: меняется при любом изменении карточек или темы"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(theme.encode("utf-8"))
+    for image_info in images:
+        digest.update(b"\0" + image_info["role"].encode("utf-8") + b"\0")
+        digest.update(image_info.get("extension", "png").encode("ascii"))
+        for name, variant in [("", image_info)] + _size_variants(image_info):
+            digest.update(name.encode("ascii"))
+            if "blob" in variant:
+                digest.update(variant["blob"].encode("ascii"))
+            else:
+                digest.update(variant["bytes"])
+    return digest.hexdigest()
+
+
+class ZipArchiveCache:
+    """
+    Кэш ZIP-архивов подборок
+
+    Архив собирается один раз на (ID подборки, хэш содержимого). Небольшие
+    архивы хранятся в памяти, крупные (больше spool_bytes) — во временном
+    файле на диске. Старые архивы вытесняются (LRU), их файлы удаляются.
+    """
+
+    def __init__(self, max_archives: int = 32, spool_bytes: int = 8 * 1024 * 1024, directory: str | None = None):
+        self.max_archives = max_archives
+        self.spool_bytes = spool_bytes
+        self.directory = directory
+        self._archives: "OrderedDict[Tuple[str, str], bytes | str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _build(self, images: List[Dict], theme: str) -> bytes | str:
+        estimated_size = sum(
+            image_info.get("size_bytes") or len(image_bytes(image_info)) for image_info in images
+        )
+        if estimated_size <= self.spool_bytes:
+            return images_to_zip(images, theme).getvalue()
+        with tempfile.NamedTemporaryFile(
+            "w+b", suffix=".zip", prefix="threads_cards_", dir=self.directory, delete=False
+        ) as spool_file:
+            images_to_zip(images, theme, spool_file)
+            return spool_file.name
+
+    @staticmethod
+    def _discard(archive: bytes | str) -> None:
+        if isinstance(archive, str):
+            try:
+                os.remove(archive)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read(archive: bytes | str) -> bytes:
+        if isinstance(archive, str):
+            with open(archive, "rb") as archive_file:
+                return archive_file.read()
+        return archive
+
+    def get(self, batch_id: str, content_hash: str, images: List[Dict], theme: str) -> bytes:
+        """
+        Возвращает содержимое архива, собирая его только при первом обращении
+
+        Файл на диске читается целиком под блокировкой, чтобы вытеснение не
+        удалило его во время чтения. Диск избавляет от хранения крупных
+        архивов в памяти между скачиваниями, но не при самой отдаче:
+        st.download_button все равно держит данные в памяти целиком.
+        """
+        key = (batch_id, content_hash)
+        with self._lock:
+            archive = self._archives.get(key)
+            if archive is not None:
+                self._archives.move_to_end(key)
+                return self._read(archive)
+
+        archive = self._build(images, theme)
+        with self._lock:
+            previous = self._archives.get(key)
+            self._archives[key] = archive
+            self._archives.move_to_end(key)
+            evicted = [previous] if previous is not None else []
+            while len(self._archives) > self.max_archives:
+                evicted.append(self._archives.popitem(last=False)[1])
+            data = self._read(archive)
+        for old_archive in evicted:
+            self._discard(old_archive)
+        return data
+
+    def clear(self) -> None:
+        """Удаляет все архивы"""
+        with self._lock:
+            archives = list(self._archives.values())
+            self._archives.clear()
+        for archive in archives:
+            self._discard(archive)
+
+
+@functools.lru_cache(maxsize=None)
+def get_zip_cache() -> ZipArchiveCache:
+    """Общий на процесс кэш ZIP-архивов"""
+    return ZipArchiveCache()
+
+
+def batch_zip(batch: Dict) -> bytes:
+    """Архив подборки из кэша; вызывается кнопкой скачивания только по нажатию"""
+    restore_images(batch)
+    content_hash = batch.get("content_hash") or batch_content_hash(batch["images"], batch["theme"])
+    return get_zip_cache().get(batch["id"], content_hash, batch["images"], batch["theme"])
+
+
+class BatchArchive:
+    """
+    Постоянный архив подборок в SQLite
+
+    Хранит метаданные подборок и описания карточек (сами изображения — в
+    CardBlobStore). Ключ — собственный ID подборки; ID от модели может
+    повторяться и хранится отдельно (model_id). Выборка постраничная,
+    карточки подгружаются только для открытой страницы.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            model_id TEXT,
+            theme TEXT NOT NULL,
+            theme_key TEXT NOT NULL,
+            topic_used TEXT,
+            replies TEXT NOT NULL,
+            cta TEXT,
+            tags TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            content_hash TEXT,
+            render_options TEXT
+        );
+        DROP INDEX IF EXISTS batches_theme;
+        CREATE INDEX IF NOT EXISTS batches_timestamp ON batches (timestamp);
+        CREATE TABLE IF NOT EXISTS batch_tags (
+            batch_id TEXT NOT NULL REFERENCES batches (id) ON DELETE CASCADE,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (batch_id, tag)
+        );
+        CREATE INDEX IF NOT EXISTS batch_tags_tag ON batch_tags (tag);
+        CREATE TABLE IF NOT EXISTS cards (
+            batch_id TEXT NOT NULL REFERENCES batches (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            info TEXT NOT NULL,
+            PRIMARY KEY (batch_id, position)
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(batches)")}
+            # Архивы, созданные до появления столбцов
+            for column in ("model_id", "render_options"):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE batches ADD COLUMN {column} TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+
+    @staticmethod
+    def _normalize_tag(tag: str) -> str:
+        return tag.strip().lstrip("#").casefold()
+
+    def save(self, batch: Dict) -> None:
+        """Сохраняет (или заменяет) подборку вместе с описаниями карточек"""
+        tags = batch.get("tags") or []
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM batches WHERE id = ?", (batch["id"],))
+            connection.execute(
+                "INSERT INTO batches (id, model_id, theme, theme_key, topic_used, replies, cta, tags, timestamp, content_hash, "
+                "render_options) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    batch["id"],
+                    batch.get("model_id"),
+                    batch["theme"],
+                    batch["theme"].casefold(),
+                    batch.get("topic_used"),
+                    json.dumps(batch.get("replies", []), ensure_ascii=False),
+                    batch.get("cta"),
+                    json.dumps(tags, ensure_ascii=False),
+                    batch["timestamp"],
+                    batch.get("content_hash"),
+                    json.dumps({field: batch[field] for field in RENDER_OPTION_FIELDS if field in batch}, ensure_ascii=False),
+                ),
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO batch_tags (batch_id, tag) VALUES (?, ?)",
+                [(batch["id"], self._normalize_tag(tag)) for tag in tags if self._normalize_tag(tag)],
+            )
+            self._insert_cards(connection, batch["id"], batch.get("images", []))
+
+    @staticmethod
+    def _insert_cards(connection: sqlite3.Connection, batch_id: str, images: List[Dict]) -> None:
+        connection.executemany(
+            "INSERT INTO cards (batch_id, position, info) VALUES (?, ?, ?)",
+            [
+                (batch_id, position, json.dumps({k: v for k, v in image_info.items() if k != "bytes"}, ensure_ascii=False))
+                for position, image_info in enumerate(images)
+            ],
+        )
+
+    def save_images(self, batch_id: str, images: List[Dict], content_hash: str) -> None:
+        """Заменяет описания карточек подборки (например, после перерисовки вытесненных)"""
+        with closing(self._connect()) as connection, connection:
+            updated = connection.execute(
+                "UPDATE batches SET content_hash = ? WHERE id = ?", (content_hash, batch_id)
+            ).rowcount
+            if updated:
+                connection.execute("DELETE FROM cards WHERE batch_id = ?", (batch_id,))
+                self._insert_cards(connection, batch_id, images)
+
+    def query(self, theme: str = "", tag: str = "", page: int = 0, page_size: int = 10) -> Tuple[List[Dict], int]:
+        """
+        Постраничный поиск подборок (новые первыми)
+
+        Поиск по подстроке темы не может использовать индекс и просматривает
+        все подборки (для локального архива это дешево); тег ищется по индексу.
+
+        Args:
+            theme: подстрока темы (без учета регистра)
+            tag: тег (с # или без)
+
+        Returns:
+            (подборки страницы без карточек, общее число найденных подборок)
+        """
+        conditions = []
+        params: List = []
+        if theme.strip():
+            escaped = theme.strip().casefold().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("theme_key LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        if self._normalize_tag(tag):
+            conditions.append("id IN (SELECT batch_id FROM batch_tags WHERE tag = ?)")
+            params.append(self._normalize_tag(tag))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with closing(self._connect()) as connection:
+            total = connection.execute(f"SELECT COUNT(*) FROM batches {where}", params).fetchone()[0]
+            rows = connection.execute(
+                f"SELECT * FROM batches {where} ORDER BY timestamp DESC, id LIMIT ? OFFSET ?",
+                params + [page_size, page * page_size],
+            ).fetchall()
+
+        batches = [
+            {
+                "id": row["id"],
+                "model_id": row["model_id"],
+                "theme": row["theme"],
+                "topic_used": row["topic_used"],
+                "replies": json.loads(row["replies"]),
+                "cta": row["cta"],
+                "tags": json.loads(row["tags"]),
+                "timestamp": row["timestamp"],
+                "content_hash": row["content_hash"],
+                **json.loads(row["render_options"] or "{}"),
+            }
+            for row in rows
+        ]
+        return batches, total
+
+    def load_images(self, batch_id: str) -> List[Dict]:
+        """Описания карточек подборки (сами изображения читаются из хранилища по ключу)"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT info FROM cards WHERE batch_id = ? ORDER BY position", (batch_id,)
+            ).fetchall()
+        return [json.loads(row["info"]) for row in rows]
+
+    def tags(self, limit: int = 200) -> List[str]:
+        """Самые частые теги архива"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT tag FROM batch_tags GROUP BY tag ORDER BY COUNT(*) DESC, tag LIMIT ?", (limit,)
+            ).fetchall()
+        return [row["tag"] for row in rows]
+
+
+@functools.lru_cache(maxsize=None)
+def get_batch_archive() -> BatchArchive:
+    """Общий на процесс архив подборок (путь задается THREADS_CARDS_ARCHIVE)"""
+    return BatchArchive(os.getenv("THREADS_CARDS_ARCHIVE", "threads_cards_archive.sqlite3"))
@@ -0,0 +1,147 @@
+"""Учет использованных тем случайной генерации"""
+
+import hashlib
+import random
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+
+class TopicIndex:
+    """
+    Ограниченный индекс уже использованных тем с поиском почти-повторов
+
+    Темы нормализуются (регистр, ё→е, пунктуация, пробелы) и сравниваются
+    по оценке MinHash для множеств символьных n-грамм; слова перед этим
+    усекаются до stem_length букв, чтобы не различать окончания —
+    «Токсичный начальник» и «токсичные начальники!» считаются одной темой. Хранится не
+    больше max_topics тем: при переполнении удаляются самые старые. В запрос
+    к модели уходят только max_exclusions тем — недавно добавленные или
+    недавно совпавшие с повтором. Индекс потокобезопасен: им пользуются
+    фоновые генерации одной сессии.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(
+        self,
+        threshold: float = 0.55,
+        shingle_size: int = 3,
+        stem_length: int = 5,
+        num_perm: int = 64,
+        max_topics: int = 500,
+        max_exclusions: int = 15,
+    ):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.stem_length = stem_length
+        self.max_topics = max_topics
+        self.max_exclusions = max_exclusions
+        rng = random.Random(num_perm)
+        self._permutations = [(rng.randrange(1, self._PRIME), rng.randrange(self._PRIME)) for _ in range(num_perm)]
+        # нормализованная тема -> (исходная тема, сигнатура); порядок — давность использования
+        self._entries: "OrderedDict[str, Tuple[str, Tuple[int, ...]]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def normalize(theme: str) -> str:
+        """Приводит тему к виду для сравнения"""
+        text = theme.lower().replace("ё", "е")
+        text = re.sub(r"[\W_]+", " ", text)
+        return " ".join(text.split())
+
+    def _signature(self, normalized: str) -> Tuple[int, ...]:
+        stems = " ".join(word[:self.stem_length] for word in normalized.split())
+        padded = f" {stems} "
+        size = self.shingle_size
+        shingles = {padded[idx:idx + size] for idx in range(max(1, len(padded) - size + 1))}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for shingle in shingles
+        ]
+        return tuple(min((a * h + b) % self._PRIME for h in hashes) for a, b in self._permutations)
+
+    @staticmethod
+    def _similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+        return sum(x == y for x, y in zip(first, second)) / len(first)
+
+    def find_duplicate(self, theme: str) -> Tuple[str, float] | None:
+        """
+        Ищет уже использованную тему, похожую на theme
+
+        Returns:
+            (найденная тема, оценка сходства) или None; найденная тема
+            становится самой свежей и попадет в следующий список исключений
+        """
+        normalized = self.normalize(theme)
+        if not normalized:
+            return None
+        signature = self._signature(normalized)
+        with self._lock:
+            if normalized in self._entries:
+                self._entries.move_to_end(normalized)
+                return self._entries[normalized][0], 1.0
+
+            best_key, best_similarity = None, 0.0
+            for key, (_, other) in self._entries.items():
+                similarity = self._similarity(signature, other)
+                if similarity > best_similarity:
+                    best_key, best_similarity = key, similarity
+            if best_key is None or best_similarity < self.threshold:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key][0], best_similarity
+
+    def add(self, theme: str) -> bool:
+        """Добавляет тему; False, если она повторяет уже известную"""
+        normalized = self.normalize(theme)
+        if not normalized:
+            return False
+        with self._lock:
+            if self.find_duplicate(theme) is not None:
+                return False
+            self._entries[normalized] = (theme, self._signature(normalized))
+            while len(self._entries) > self.max_topics:
+                self._entries.popitem(last=False)
+        return True
+
+    def exclusions(self) -> List[str]:
+        """Ограниченный список тем для запроса модели, начиная с самых свежих"""
+        with self._lock:
+            recent = list(reversed(self._entries.values()))[:self.max_exclusions]
+        return [theme for theme, _ in recent]
+
+    @property
+    def themes(self) -> List[str]:
+        """Все темы индекса, от старых к новым"""
+        with self._lock:
+            return [theme for theme, _ in self._entries.values()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def load_topics(path: str) -> List[str]:
+    """Темы из файла: пустые строки и строки с # пропускаются, повторы убираются"""
+    topics = []
+    seen = set()
+    with open(path, encoding="utf-8") as topics_file:
+        for line in topics_file:
+            topic = line.strip()
+            if topic and not topic.startswith("#") and topic not in seen:
+                seen.add(topic)
+                topics.append(topic)
+    return topics
+
+
+def build_random_topic_request(history: List[str]) -> str:
+    """Формирует текст запроса для случайной темы (history — темы, которые нужно исключить)"""
+    if not history:
+        return "Любая тема, которая точно удивит"
+    history_text = ", ".join(history)
+    return f"Любая, кроме {history_text}"